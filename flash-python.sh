@@ -3,8 +3,17 @@
 export AMPY_PORT=/dev/ttyUSB0
 export DEVICENAME=${1}
 
+ampy put src/lib/aio.py aio.py
+ampy put src/lib/deadline.py deadline.py
+ampy put src/lib/dnscache.py dnscache.py
+ampy put src/lib/buttons.py buttons.py
+ampy put src/lib/power.py power.py
+ampy put src/lib/storage.py storage.py
+ampy put src/lib/telemetry.py telemetry.py
 ampy put src/lib/wifi.py wifi.py
 ampy put src/lib/mqtt.py mqtt.py
+ampy put src/lib/jsonstream.py jsonstream.py
+ampy put src/lib/httpclient.py httpclient.py
 ampy put src/lib/mytrix.py mytrix.py
 ampy put config/config_base.json config_base.json
 ampy put config/config_${DEVICENAME}.json config_device.json
@@ -0,0 +1,72 @@
+# Small compatibility layer so the same tasks run on uasyncio (MicroPython) and asyncio (CPython).
+#
+# Only the few primitives the application needs are wrapped: millisecond sleeps and timeouts, a flag
+# that can be set from an interrupt handler and waiting for a socket to become readable or writable.
+
+try:
+    import uasyncio as asyncio
+    from uasyncio import core as _core
+except ImportError:
+    import asyncio
+
+    _core = None
+
+if _core:
+    sleep_ms = asyncio.sleep_ms
+    wait_for_ms = asyncio.wait_for_ms
+    ThreadSafeFlag = asyncio.ThreadSafeFlag
+
+    async def wait_readable(sock):
+        """Suspend the calling task until sock has data to read."""
+        yield _core._io_queue.queue_read(sock)
+
+    async def wait_writable(sock):
+        """Suspend the calling task until sock accepts more data."""
+        yield _core._io_queue.queue_write(sock)
+
+else:
+
+    async def sleep_ms(ms):
+        await asyncio.sleep(ms / 1000)
+
+    def wait_for_ms(aw, ms):
+        return asyncio.wait_for(aw, ms / 1000)
+
+    class ThreadSafeFlag:
+        """Stand-in for uasyncio.ThreadSafeFlag, settable from other threads."""
+
+        def __init__(self):
+            self._loop = None
+            self._event = asyncio.Event()
+
+        def set(self):
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._event.set)
+            else:
+                self._event.set()
+
+        async def wait(self):
+            self._loop = asyncio.get_event_loop()
+            await self._event.wait()
+            self._event.clear()
+
+    async def _wait_fd(sock, add, remove):
+        # registered by file descriptor, so it can be removed after sock was closed
+        fd = sock.fileno()
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        add(fd, lambda: fut.done() or fut.set_result(None))
+        try:
+            await fut
+        finally:
+            remove(fd)
+
+    async def wait_readable(sock):
+        """Suspend the calling task until sock has data to read."""
+        loop = asyncio.get_event_loop()
+        await _wait_fd(sock, loop.add_reader, loop.remove_reader)
+
+    async def wait_writable(sock):
+        """Suspend the calling task until sock accepts more data."""
+        loop = asyncio.get_event_loop()
+        await _wait_fd(sock, loop.add_writer, loop.remove_writer)
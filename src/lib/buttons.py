@@ -0,0 +1,198 @@
+# Interrupt driven, debounced push buttons.
+#
+# Pin interrupts only record which button changed and when, in a preallocated ring buffer that the
+# interrupt handler writes and the consuming task reads, so the handler never allocates or blocks.
+# The task debounces the edges, turns them into button events and sleeps while nothing happens.
+
+import utime
+from uarray import array
+from aio import asyncio, wait_for_ms, ThreadSafeFlag
+
+
+class ButtonEvent:
+    PRESS = 1
+    LONG_PRESS = 2
+    DOUBLE_PRESS = 3
+
+
+class Buttons:
+    """A group of active-low buttons delivering (key, ButtonEvent) tuples from get().
+
+    A press is reported as soon as the pin has been stable for debounce_ms. A second press within
+    double_press_ms of the first is reported as DOUBLE_PRESS instead of PRESS, and holding a button for
+    long_press_ms additionally reports LONG_PRESS.
+    """
+
+    def __init__(self, debounce_ms=30, long_press_ms=1500, double_press_ms=400, queue_size=16):
+        self.debounce_ms = debounce_ms
+        self.long_press_ms = long_press_ms
+        self.double_press_ms = double_press_ms
+
+        self._keys = []
+        self._pins = []
+        # debounced level, ticks when to sample the pin again, ticks of the last press, ticks the
+        # button went down if it is held and no LONG_PRESS was reported yet
+        self._level = []
+        self._settle = []
+        self._pressed = []
+        self._held = []
+
+        self._ring_button = bytearray(queue_size)
+        self._ring_ticks = array("i", [0] * queue_size)
+        self._head = 0
+        self._tail = 0
+        self._overflow = False
+        self._flag = ThreadSafeFlag()
+        self._wakeup = asyncio.Event()
+        self._relay = None
+        self._events = []
+
+    def add(self, key, pin, wake=None):
+        """Watch a machine.Pin configured as input with pull-up. Events carry the given key.
+
+        The optional wake argument is passed on to Pin.irq(), e.g. machine.SLEEP to wake the board
+        from lightsleep. Pins that cannot wake the board are still watched.
+        """
+        index = len(self._pins)
+        self._keys.append(key)
+        self._pins.append(pin)
+        self._level.append(pin.value())
+        self._settle.append(None)
+        self._pressed.append(None)
+        self._held.append(None)
+        handler = self._make_handler(index)
+        if wake:
+            try:
+                pin.irq(handler, pin.IRQ_FALLING | pin.IRQ_RISING, wake=wake)
+                return
+            except (ValueError, TypeError) as e:
+                print("button", key, "cannot wake the board:", e)
+        pin.irq(handler, pin.IRQ_FALLING | pin.IRQ_RISING)
+
+    def clear(self):
+        """Stop watching all buttons, e.g. to add them again with a new pin layout.
+
+        Edges recorded but not turned into events yet are dropped, as their indices refer to the old pins.
+        """
+        for pin in self._pins:
+            pin.irq(None)
+        self._keys = []
+        self._pins = []
+        self._level = []
+        self._settle = []
+        self._pressed = []
+        self._held = []
+        self._tail = self._head
+        self._overflow = False
+
+    def _make_handler(self, index):
+        size = len(self._ring_button)
+
+        def handler(pin):
+            head = self._head
+            nxt = (head + 1) % size
+            if nxt == self._tail:
+                self._overflow = True
+            else:
+                self._ring_button[head] = index
+                self._ring_ticks[head] = utime.ticks_ms()
+                self._head = nxt
+            self._flag.set()
+
+        return handler
+
+    def _drain(self):
+        while self._tail != self._head:
+            tail = self._tail
+            self._settle[self._ring_button[tail]] = utime.ticks_add(self._ring_ticks[tail], self.debounce_ms)
+            self._tail = (tail + 1) % len(self._ring_button)
+        if self._overflow:
+            self._overflow = False
+            now = utime.ticks_add(utime.ticks_ms(), self.debounce_ms)
+            for i in range(len(self._pins)):
+                self._settle[i] = now
+
+    # Turn settled edges and held buttons into events. Returns the
+    # number of ms until something is due again, or None.
+    def _process(self):
+        self._drain()
+        now = utime.ticks_ms()
+        next_due = None
+        for i in range(len(self._pins)):
+            settle = self._settle[i]
+            if settle is not None:
+                left = utime.ticks_diff(settle, now)
+                if left > 0:
+                    next_due = left if next_due is None else min(next_due, left)
+                else:
+                    self._settle[i] = None
+                    self._update(i, self._pins[i].value(), now)
+            held = self._held[i]
+            if held is not None:
+                left = self.long_press_ms - utime.ticks_diff(now, held)
+                if left > 0:
+                    next_due = left if next_due is None else min(next_due, left)
+                else:
+                    self._held[i] = None
+                    self._events.append((self._keys[i], ButtonEvent.LONG_PRESS))
+        return next_due
+
+    def _update(self, i, level, now):
+        if level == self._level[i]:
+            return
+        self._level[i] = level
+        if level:
+            self._held[i] = None
+            return
+        pressed = self._pressed[i]
+        if pressed is not None and utime.ticks_diff(now, pressed) < self.double_press_ms:
+            self._pressed[i] = None
+            self._events.append((self._keys[i], ButtonEvent.DOUBLE_PRESS))
+        else:
+            self._pressed[i] = now
+            self._events.append((self._keys[i], ButtonEvent.PRESS))
+        self._held[i] = now
+
+    def due_in(self):
+        """Number of ms until the button task has something to do, or None if all buttons are idle."""
+        if self._events or self._head != self._tail or self._overflow:
+            return 0
+        now = utime.ticks_ms()
+        due = None
+        for i in range(len(self._pins)):
+            if self._settle[i] is not None:
+                left = max(0, utime.ticks_diff(self._settle[i], now))
+                due = left if due is None else min(due, left)
+            if self._held[i] is not None:
+                left = max(0, self.long_press_ms - utime.ticks_diff(now, self._held[i]))
+                due = left if due is None else min(due, left)
+        return due
+
+    @property
+    def flag(self):
+        """The ThreadSafeFlag set by the pin interrupts. It can be registered with uselect.poll."""
+        return self._flag
+
+    async def _relay_flag(self):
+        # ThreadSafeFlag.wait() cannot be safely cancelled by a timeout,
+        # so a helper task passes it on to an Event that can.
+        while True:
+            await self._flag.wait()
+            self._wakeup.set()
+
+    async def get(self):
+        """Wait for the next button event and return it as (key, ButtonEvent)."""
+        if self._relay is None:
+            self._relay = asyncio.create_task(self._relay_flag())
+        while True:
+            self._wakeup.clear()
+            timeout = self._process()
+            if self._events:
+                return self._events.pop(0)
+            if timeout is None:
+                await self._wakeup.wait()
+            else:
+                try:
+                    await wait_for_ms(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
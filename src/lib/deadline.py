@@ -0,0 +1,66 @@
+# Time budgets for network operations.
+#
+# An operation creates one Deadline and hands it down to every call that may block, each of which
+# waits at most what is left of it: socket timeouts are set from it and poll() is given it as timeout.
+# Once it has run out, DeadlineExceeded is raised. That is an OSError with errno ETIMEDOUT, so callers
+# retrying on network errors retry on it as well, and a slow peer fails a single operation instead of
+# blocking the event loop until the watchdog resets the board.
+
+import uerrno
+import uselect
+import utime
+from aio import asyncio, wait_for_ms, wait_readable, wait_writable
+
+
+class DeadlineExceeded(OSError):
+    """An operation did not finish in time. args are (ETIMEDOUT, what timed out)."""
+
+    def __init__(self, what):
+        super().__init__(uerrno.ETIMEDOUT, what)
+
+
+def timed_out(e, what):
+    """Return the OSError e of a socket as DeadlineExceeded if it was raised by a socket timeout."""
+    if e.args and e.args[0] == uerrno.ETIMEDOUT and not isinstance(e, DeadlineExceeded):
+        return DeadlineExceeded(what)
+    return e
+
+
+class Deadline:
+    """The point in time ms from now by which an operation has to be done."""
+
+    def __init__(self, ms):
+        self.at = utime.ticks_add(utime.ticks_ms(), ms)
+
+    def remaining(self):
+        """Number of ms left, 0 once the deadline has passed."""
+        return max(0, utime.ticks_diff(self.at, utime.ticks_ms()))
+
+    def check(self, what):
+        """Return the number of ms left, raise DeadlineExceeded if there are none."""
+        left = self.remaining()
+        if not left:
+            raise DeadlineExceeded(what)
+        return left
+
+    def settimeout(self, sock, what):
+        """Let blocking calls on sock wait at most until the deadline.
+
+        They raise OSError(ETIMEDOUT) after that, see timed_out().
+        """
+        sock.settimeout(self.check(what) / 1000)
+
+    def poll(self, sock, event, what):
+        """Block until sock is ready for the uselect event, at most until the deadline."""
+        poller = uselect.poll()
+        poller.register(sock, event)
+        if not poller.poll(self.check(what)):
+            raise DeadlineExceeded(what)
+
+    async def wait(self, sock, event, what):
+        """Awaitable counterpart of poll for uasyncio tasks."""
+        waiting = wait_readable(sock) if event == uselect.POLLIN else wait_writable(sock)
+        try:
+            await wait_for_ms(waiting, self.check(what))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(what)
@@ -0,0 +1,237 @@
+# Cache of DNS lookups, shared by the MQTT and the HTTP client.
+#
+# getaddrinfo() neither reports the TTL of an answer nor can it be interrupted, so hosts are looked up
+# with a query of our own to the nameserver of the station interface, over UDP and by the deadline of
+# the operation that needs the address.
+#
+# Addresses are kept for the TTL of their answer. After that they are stale: run(), a uasyncio task,
+# looks them up again in the background while the stale address is still handed out, and it is kept
+# if that lookup fails. Addresses are stored on flash whenever they change, and after a reset they are
+# used right away as stale ones, so the first connection does not wait for the nameserver.
+
+import usocket as socket
+import ustruct as struct
+import uselect
+import urandom
+import utime
+from aio import asyncio
+from deadline import Deadline, DeadlineExceeded
+from storage import read_json, write_json
+
+
+class DNSError(OSError):
+    """The nameserver could not resolve a host. args are (DNS response code, host)."""
+
+
+def _is_address(host):
+    parts = host.split(".")
+    return len(parts) == 4 and all(part.isdigit() for part in parts)
+
+
+def _query(qid, host):
+    # recursive query for the A record of host
+    query = bytearray(struct.pack(">HHHHHH", qid, 0x0100, 1, 0, 0, 0))
+    for label in host.split("."):
+        query.append(len(label))
+        query.extend(label.encode())
+    query.extend(b"\x00\x00\x01\x00\x01")
+    return query
+
+
+def _skip_name(data, i):
+    while True:
+        n = data[i]
+        if n & 0xC0 == 0xC0:
+            return i + 2
+        if n == 0:
+            return i + 1
+        i += n + 1
+
+
+def _answer(qid, host, data):
+    # (address, ttl in s) from the response to query qid, None if data is not that response
+    if len(data) < 12 or data[0] << 8 | data[1] != qid or not data[2] & 0x80:
+        return None
+    rcode = data[3] & 0x0F
+    if rcode:
+        raise DNSError(rcode, host)
+    try:
+        answer = _parse_records(data)
+    except IndexError:
+        # truncated or malformed, the same as no address at all
+        answer = None
+    if answer is None:
+        raise DNSError(0, host)
+    return answer
+
+
+def _parse_records(data):
+    # the first A record of a response, or None
+    i = 12
+    for _ in range(data[4] << 8 | data[5]):
+        i = _skip_name(data, i) + 4
+    ttl = None
+    # the A record may follow a chain of CNAMEs, the shortest TTL of all of them applies
+    for _ in range(data[6] << 8 | data[7]):
+        i = _skip_name(data, i)
+        type_ = data[i] << 8 | data[i + 1]
+        record_ttl = data[i + 4] << 24 | data[i + 5] << 16 | data[i + 6] << 8 | data[i + 7]
+        length = data[i + 8] << 8 | data[i + 9]
+        i += 10
+        ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        if type_ == 1 and length == 4:
+            if i + 4 > len(data):
+                raise IndexError("truncated A record")
+            return "%d.%d.%d.%d" % tuple(data[i : i + 4]), ttl
+        i += length
+    return None
+
+
+class Resolver:
+    """Looks up hosts and caches their addresses, see above.
+
+    A lookup takes at most timeout ms, sending the query again every resend ms. TTLs are clamped to
+    min_ttl..max_ttl seconds. An address stale for longer than max_stale seconds is only used if
+    looking it up again fails, and so are stale addresses while run() is not running.
+    """
+
+    def __init__(self, path="dns.json", timeout=2000, resend=500, min_ttl=60, max_ttl=86400, max_stale=86400):
+        self.path = path
+        self.timeout = timeout
+        self.resend = resend
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.max_stale = max_stale
+        # host -> [address, utime.time() when it becomes stale], loaded on first use
+        self._cache = None
+        # stale hosts to look up in the background, oldest first
+        self._pending = []
+        self._running = False
+        self._wakeup = asyncio.Event()
+
+    def _load(self):
+        now = utime.time()
+        stored = read_json(self.path, {})
+        if not isinstance(stored, dict):
+            stored = {}
+        self._cache = {host: [address, now] for host, address in stored.items()}
+
+    def _store(self, host, address, ttl):
+        entry = self._cache.get(host)
+        changed = not entry or entry[0] != address
+        self._cache[host] = [address, utime.time() + min(max(ttl, self.min_ttl), self.max_ttl)]
+        if changed:
+            write_json(self.path, {name: cached[0] for name, cached in self._cache.items()})
+
+    def _nameserver(self):
+        # the one handed out by DHCP, or set with the ifconfig of the wifi config
+        try:
+            import network
+
+            server = network.WLAN(network.STA_IF).ifconfig()[3]
+        except (ImportError, OSError):
+            return None
+        return None if server == "0.0.0.0" else server
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        return sock, urandom.getrandbits(16)
+
+    def _lookup(self, host, deadline):
+        # (address, ttl), blocking until the answer arrives or the deadline has passed
+        server = self._nameserver()
+        if server is None:
+            # no nameserver known, leave it to the system
+            address = socket.getaddrinfo(host, 0)[0][-1][0]
+            deadline.check("dns " + host)
+            return address, self.min_ttl
+        sock, qid = self._open()
+        try:
+            query = _query(qid, host)
+            while True:
+                sock.sendto(query, (server, 53))
+                attempt = Deadline(min(self.resend, deadline.check("dns " + host)))
+                try:
+                    while True:
+                        attempt.poll(sock, uselect.POLLIN, "dns " + host)
+                        answer = _answer(qid, host, sock.recv(512))
+                        if answer:
+                            return answer
+                except DeadlineExceeded:
+                    pass
+        finally:
+            sock.close()
+
+    async def _await_lookup(self, host, deadline):
+        # awaitable counterpart of _lookup
+        server = self._nameserver()
+        if server is None:
+            return self._lookup(host, deadline)
+        sock, qid = self._open()
+        try:
+            query = _query(qid, host)
+            while True:
+                sock.sendto(query, (server, 53))
+                attempt = Deadline(min(self.resend, deadline.check("dns " + host)))
+                try:
+                    while True:
+                        await attempt.wait(sock, uselect.POLLIN, "dns " + host)
+                        answer = _answer(qid, host, sock.recv(512))
+                        if answer:
+                            return answer
+                except DeadlineExceeded:
+                    pass
+        finally:
+            sock.close()
+
+    def resolve(self, host, port, deadline=None):
+        """Return the socket address (address, port) of host.
+
+        Only a host that is not cached yet is looked up right away, within timeout ms and by the
+        deadline if one is given. Raises DNSError or DeadlineExceeded if that fails.
+        """
+        if _is_address(host):
+            return host, port
+        if self._cache is None:
+            self._load()
+        entry = self._cache.get(host)
+        now = utime.time()
+        if entry and now < entry[1]:
+            return entry[0], port
+        if entry and self._running and now - entry[1] < self.max_stale:
+            if host not in self._pending:
+                self._pending.append(host)
+                self._wakeup.set()
+            return entry[0], port
+        budget = self.timeout if deadline is None else min(self.timeout, deadline.remaining())
+        try:
+            self._store(host, *self._lookup(host, Deadline(budget)))
+        except OSError as e:
+            if not entry:
+                raise
+            print("dns lookup of", host, "failed, using the cached address:", e)
+        return self._cache[host][0], port
+
+    def due_in(self):
+        """0 while stale hosts are being looked up, otherwise None."""
+        return 0 if self._pending else None
+
+    async def run(self):
+        """Look up stale hosts in the background forever."""
+        self._running = True
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            host = self._pending[0]
+            try:
+                self._store(host, *(await self._await_lookup(host, Deadline(self.timeout))))
+            except OSError as e:
+                print("dns lookup of", host, "failed, using the cached address:", e)
+            self._pending.pop(0)
+
+
+# Shared by all clients, so a host is looked up only once.
+resolver = Resolver()
@@ -0,0 +1,312 @@
+# Small HTTP/1.1 client with keep-alive connections.
+#
+# urequests opens a new connection for every request, which for https means a full TLS handshake each
+# time. Pool keeps finished connections open per host and reuses them for the next request.
+#
+# Each exchange is written once as a generator that yields (socket, poll event) whenever it has to
+# wait for the peer. request() runs it blocking in poll(), await_request() runs it from a uasyncio
+# task, suspending only the calling task. Either way the whole exchange, from connecting to the end of
+# the response, has to be done by the deadline of the request, see deadline.py.
+
+import usocket as socket
+import uerrno
+import ujson
+import uselect
+import utime
+from deadline import Deadline, timed_out
+from dnscache import resolver
+
+
+class Response:
+    """Response to a single request. It parses itself from the raw bytes passed to feed().
+
+    If a parser is given, the body of a successful (2xx) response is passed on to its feed() method
+    as it arrives instead of being kept in memory, and json() returns the parser's result().
+    """
+
+    def __init__(self, parser=None):
+        self.status_code = None
+        self.reason = b""
+        self.keep_alive = False
+        self.done = False
+        self._head = b""
+        self._body = bytearray()
+        self._length = None
+        self._chunked = False
+        self._trailer = False
+        self._line = b""
+        self._parser = parser
+
+    @property
+    def content(self):
+        return bytes(self._body)
+
+    def json(self):
+        if self._parser:
+            return self._parser.result()
+        return ujson.loads(self.content)
+
+    def _parse_head(self, head):
+        lines = head.split(b"\r\n")
+        status = lines[0].split(b" ", 2)
+        if len(status) < 2 or not status[0].startswith(b"HTTP/"):
+            raise ValueError("malformed HTTP response")
+        self.status_code = int(status[1])
+        self.reason = status[2] if len(status) > 2 else b""
+        if not 200 <= self.status_code < 300:
+            # error bodies are small and read as a whole
+            self._parser = None
+        self.keep_alive = status[0] == b"HTTP/1.1"
+        for line in lines[1:]:
+            key, _, value = line.partition(b":")
+            key = key.strip().lower()
+            value = value.strip().lower()
+            if key == b"content-length":
+                self._length = int(value)
+            elif key == b"transfer-encoding":
+                self._chunked = value == b"chunked"
+            elif key == b"connection":
+                self.keep_alive = value == b"keep-alive"
+        if self.status_code in (204, 304):
+            self._length = 0
+        if self._length is None and not self._chunked:
+            # body ends when the server closes the connection
+            self.keep_alive = False
+        self.done = self._length == 0
+
+    def _on_body(self, data):
+        if self._parser:
+            self._parser.feed(data)
+        else:
+            self._body.extend(data)
+
+    def feed(self, data):
+        """Parse the next piece of the response."""
+        if self.status_code is None:
+            self._head += bytes(data)
+            end = self._head.find(b"\r\n\r\n")
+            if end < 0:
+                return
+            data = memoryview(self._head)[end + 4 :]
+            self._parse_head(self._head[:end])
+            self._head = b""
+        while data and not self.done:
+            if not self._chunked:
+                if self._length is None:
+                    self._on_body(data)
+                    return
+                n = min(self._length, len(data))
+                self._on_body(data[:n])
+                data = data[n:]
+                self._length -= n
+                self.done = self._length == 0
+            elif self._length:
+                n = min(self._length, len(data))
+                self._on_body(data[:n])
+                data = data[n:]
+                self._length -= n
+            else:
+                # chunk size line, the CRLF after a chunk, or the trailer
+                line = bytes(data)
+                end = line.find(b"\n")
+                if end < 0:
+                    self._line += line
+                    return
+                data = data[end + 1 :]
+                line = (self._line + line[:end]).strip()
+                self._line = b""
+                if self._trailer:
+                    self.done = not line
+                elif self._length is None:
+                    self._length = int(line.split(b";")[0], 16)
+                    self._trailer = self._length == 0
+                else:
+                    self._length = None
+
+    def eof(self):
+        """Mark the end of the connection."""
+        if self._length is None and not self._chunked and self.status_code is not None:
+            self.done = True
+        if not self.done:
+            raise OSError(uerrno.ECONNRESET)
+
+
+def split_url(url):
+    """Split an http(s) URL into (ssl, host, port, path)."""
+    proto, _, host, path = (url + "/").split("/", 3)
+    if proto == "http:":
+        use_ssl, port = False, 80
+    elif proto == "https:":
+        use_ssl, port = True, 443
+    else:
+        raise ValueError("unsupported protocol: " + proto)
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+    return use_ssl, host, port, "/" + path[:-1]
+
+
+def _connect(host, port, use_ssl, deadline):
+    addr = resolver.resolve(host, port, deadline)
+    sock = socket.socket()
+    try:
+        sock.setblocking(False)
+        try:
+            sock.connect(addr)
+        except OSError as e:
+            if e.args[0] != uerrno.EINPROGRESS:
+                raise
+        yield sock, uselect.POLLOUT
+        if use_ssl:
+            import ussl
+
+            deadline.settimeout(sock, "http tls")
+            sock = ussl.wrap_socket(sock, server_hostname=host)
+            sock.setblocking(False)
+    except OSError as e:
+        sock.close()
+        raise timed_out(e, "http tls")
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def _write(sock, data):
+    data = memoryview(data)
+    while data:
+        n = sock.write(data)
+        if n is None:
+            yield sock, uselect.POLLOUT
+        else:
+            data = data[n:]
+
+
+def _read_response(sock, res, buf):
+    while not res.done:
+        n = sock.readinto(buf)
+        if n is None:
+            yield sock, uselect.POLLIN
+        elif n == 0:
+            res.eof()
+        else:
+            res.feed(buf[:n])
+
+
+def _is_alive(sock):
+    # An idle keep-alive connection must have nothing to read. EOF means
+    # the server closed it, anything else would confuse the next response.
+    try:
+        return sock.read(1) is None
+    except OSError:
+        return False
+
+
+class Pool:
+    """Keep-alive connections to HTTP servers, keyed by (ssl, host, port).
+
+    At most max_idle finished connections are kept per server, and idle connections are dropped after
+    idle_timeout ms. If a reused connection turns out to be closed by the server before any response
+    arrived, the request is sent again on a new connection. Requests not done by their deadline fail
+    with deadline.DeadlineExceeded.
+    """
+
+    def __init__(self, max_idle=2, idle_timeout=30000, timeout=5000):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._buf = bytearray(512)
+
+    def _take(self, key):
+        conns = self._idle.get(key)
+        while conns:
+            sock, since = conns.pop()
+            if utime.ticks_diff(utime.ticks_ms(), since) < self.idle_timeout and _is_alive(sock):
+                return sock
+            sock.close()
+        return None
+
+    def _give(self, key, sock):
+        conns = self._idle.setdefault(key, [])
+        if len(conns) >= self.max_idle:
+            conns.pop(0)[0].close()
+        conns.append((sock, utime.ticks_ms()))
+
+    def close(self):
+        """Close all idle connections."""
+        for conns in self._idle.values():
+            for sock, _ in conns:
+                sock.close()
+        self._idle = {}
+
+    def _exchange(self, method, url, json, headers, parser, deadline):
+        use_ssl, host, port, path = split_url(url)
+        key = (use_ssl, host, port)
+        body = b""
+        if json is not None:
+            body = ujson.dumps(json).encode()
+
+        head = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n" % (method, path, host, len(body))
+        if json is not None:
+            head += "Content-Type: application/json\r\n"
+        for name, value in headers.items():
+            head += "%s: %s\r\n" % (name, value)
+        head = (head + "\r\n").encode() + body
+
+        while True:
+            sock = self._take(key)
+            reused = sock is not None
+            if not reused:
+                sock = yield from _connect(host, port, use_ssl, deadline)
+            res = Response(parser)
+            try:
+                yield from _write(sock, head)
+                yield from _read_response(sock, res, memoryview(self._buf))
+            except OSError:
+                sock.close()
+                if reused and res.status_code is None:
+                    continue
+                raise
+            except:
+                sock.close()
+                raise
+            if res.keep_alive:
+                self._give(key, sock)
+            else:
+                sock.close()
+            return res
+
+    def request(self, method, url, json=None, headers={}, parser=None, deadline=None):
+        """Send a request, blocking until the response is complete.
+
+        The optional parser receives the body of a successful response, see Response. The request has
+        to be done by the given deadline.Deadline, within timeout ms of the pool without one.
+        """
+        deadline = deadline or Deadline(self.timeout)
+        gen = self._exchange(method, url, json, headers, parser, deadline)
+        try:
+            while True:
+                sock, event = next(gen)
+                deadline.poll(sock, event, "http")
+        except StopIteration as e:
+            return e.args[0]
+        finally:
+            gen.close()
+
+    async def await_request(self, method, url, json=None, headers={}, parser=None, deadline=None):
+        """Awaitable counterpart of request for uasyncio tasks."""
+        deadline = deadline or Deadline(self.timeout)
+        gen = self._exchange(method, url, json, headers, parser, deadline)
+        try:
+            while True:
+                sock, event = next(gen)
+                await deadline.wait(sock, event, "http")
+        except StopIteration as e:
+            return e.args[0]
+        finally:
+            gen.close()
+
+
+# Shared by all clients, so requests to the same server reuse connections.
+pool = Pool()
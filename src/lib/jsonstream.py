@@ -0,0 +1,185 @@
+# Incremental JSON parser that keeps only selected fields.
+#
+# ujson.loads() needs the whole document in RAM and builds every object in it. Parser is fed the
+# document piece by piece as it arrives from the socket and only builds the parts named in a selection,
+# so the memory needed depends on the selected fields, not on the size of the response.
+#
+# A selection mirrors the shape of the document:
+# * True keeps the value, including everything inside it,
+# * a dict keeps only the listed keys of an object, each with its own selection,
+# * a list with one selection applies it to every element of an array.
+# Keys missing from a dict selection are skipped, as are values whose type does not match the selection.
+#
+#     {"chunk": [{"type": True, "content": {"body": True}}], "end": True}
+
+import ujson
+
+# byte values, since MicroPython cannot look up an int in bytes
+_WHITESPACE = (0x20, 0x09, 0x0D, 0x0A)
+_LITERAL_END = (0x20, 0x09, 0x0D, 0x0A, 0x2C, 0x5D, 0x7D)
+_QUOTE = 0x22
+_OPEN_OBJECT = 0x7B
+_CLOSE_OBJECT = 0x7D
+_OPEN_ARRAY = 0x5B
+_CLOSE_ARRAY = 0x5D
+
+
+def _decode_string(raw):
+    if b"\\" in raw:
+        return ujson.loads(b'"' + raw + b'"')
+    return raw.decode()
+
+
+class Parser:
+    """Parse a JSON document fed in pieces, building only the selected parts of it."""
+
+    def __init__(self, select=True):
+        self.select = select
+        # one [container, selection for its values, pending key] per open object or array
+        self._stack = []
+        # depth of the skipped container we are in, 0 outside
+        self._skip = 0
+        # raw bytes of the current string and whether they are kept, None outside of strings
+        self._string = None
+        self._keep_string = False
+        self._escape = False
+        # raw bytes of the current number, true, false or null, None outside of literals
+        self._literal = None
+        self._done = False
+        self._result = None
+
+    def result(self):
+        """Return the selected parts of the document. Raises ValueError if it is incomplete."""
+        if not self._done and self._literal is not None and not self._stack:
+            self._end_literal()
+        if not self._done:
+            raise ValueError("incomplete JSON document")
+        return self._result
+
+    def feed(self, data):
+        """Parse the next piece of the document."""
+        data = bytes(data)
+        i = 0
+        n = len(data)
+        while i < n:
+            if self._string is not None:
+                i = self._scan_string(data, i)
+                continue
+            if self._literal is not None:
+                j = i
+                while j < n and data[j] not in _LITERAL_END:
+                    j += 1
+                self._literal += data[i:j]
+                i = j
+                if i < n:
+                    self._end_literal()
+                continue
+
+            c = data[i]
+            i += 1
+            if c in _WHITESPACE or c == 0x2C or c == 0x3A:  # , :
+                continue
+            if c == _QUOTE:
+                self._string = b""
+                self._keep_string = not self._skip and (self._expects_key() or self._selection() is True)
+            elif self._skip:
+                if c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                    self._skip += 1
+                elif c == _CLOSE_OBJECT or c == _CLOSE_ARRAY:
+                    self._skip -= 1
+                    if not self._skip:
+                        self._value(None, False)
+            elif c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                self._open(c)
+            elif c == _CLOSE_OBJECT or c == _CLOSE_ARRAY:
+                frame = self._stack.pop()
+                self._value(frame[0], True)
+            elif self._done:
+                raise ValueError("trailing data after JSON document")
+            else:
+                self._literal = bytes((c,))
+
+    def _scan_string(self, data, i):
+        # Consume string content starting at i, return the index after it.
+        n = len(data)
+        j = i
+        while j < n:
+            if self._escape:
+                self._escape = False
+                j += 1
+                continue
+            quote = data.find(b'"', j)
+            backslash = data.find(b"\\", j, n if quote < 0 else quote)
+            if backslash >= 0:
+                self._escape = True
+                j = backslash + 1
+                continue
+            if quote < 0:
+                break
+            if self._keep_string:
+                self._string += data[i:quote]
+            self._end_string()
+            return quote + 1
+        if self._keep_string:
+            self._string += data[i:n]
+        return n
+
+    def _end_string(self):
+        raw = self._string
+        self._string = None
+        if self._skip:
+            return
+        if self._expects_key():
+            self._stack[-1][2] = _decode_string(raw)
+        elif self._keep_string:
+            self._value(_decode_string(raw), True)
+        else:
+            self._value(None, False)
+
+    def _end_literal(self):
+        raw = self._literal
+        self._literal = None
+        if self._selection() is True:
+            self._value(ujson.loads(raw), True)
+        else:
+            self._value(None, False)
+
+    def _expects_key(self):
+        return self._stack and type(self._stack[-1][0]) is dict and self._stack[-1][2] is None
+
+    def _selection(self):
+        # Selection for the value that starts next, None if it is skipped.
+        if not self._stack:
+            return self.select
+        container, select, key = self._stack[-1]
+        if select is True or type(container) is list:
+            return select
+        return select.get(key)
+
+    def _open(self, c):
+        select = self._selection()
+        if select is True:
+            inner = True
+        elif c == _OPEN_OBJECT and type(select) is dict:
+            inner = select
+        elif c == _OPEN_ARRAY and type(select) is list:
+            inner = select[0]
+        else:
+            self._skip = 1
+            return
+        self._stack.append([{} if c == _OPEN_OBJECT else [], inner, None])
+
+    def _value(self, value, keep):
+        # Store a complete value in its parent, or as the result.
+        if not self._stack:
+            self._result = value
+            self._done = True
+            return
+        frame = self._stack[-1]
+        if type(frame[0]) is list:
+            if keep:
+                frame[0].append(value)
+        else:
+            if keep:
+                frame[0][frame[2]] = value
+            frame[2] = None
@@ -6,14 +6,136 @@
 
 import usocket as socket
 import ustruct as struct
+import uerrno
+import uselect
 from ubinascii import hexlify
 import utime
+import urandom
+from aio import asyncio, wait_readable, wait_for_ms
+from deadline import Deadline, DeadlineExceeded, timed_out
+from dnscache import resolver
 
 class MQTTException(Exception):
     pass
 
+def _to_bytes(s):
+    return s.encode() if isinstance(s, str) else s
+
+class MQTTEncoder:
+    """Serializes MQTT packets into a reusable buffer.
+
+    Every packet method writes one complete packet to the start of buf and returns its length, so the
+    packet can be sent with a single write of buf[:n]. The buffer is reused for the next packet and
+    only reallocated if a packet does not fit. The encoder does no I/O and can be used on its own.
+    """
+
+    def __init__(self, size=128):
+        self.buf = bytearray(size)
+
+    def _header(self, op, sz):
+        assert sz < 2097152
+        if sz + 5 > len(self.buf):
+            self.buf = bytearray(sz + 5)
+        buf = self.buf
+        buf[0] = op
+        i = 1
+        while sz > 0x7f:
+            buf[i] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
+
+    def _bytes(self, pos, b):
+        end = pos + len(b)
+        self.buf[pos:end] = b
+        return end
+
+    def _str(self, pos, s):
+        struct.pack_into("!H", self.buf, pos, len(s))
+        return self._bytes(pos + 2, s)
+
+    def connect(self, client_id, clean_session=True, keepalive=0, user=None, password=None,
+                lw_topic=None, lw_msg=None, lw_qos=0, lw_retain=False):
+        client_id = _to_bytes(client_id)
+        sz = 10 + 2 + len(client_id)
+        flags = clean_session << 1
+        if user is not None:
+            user = _to_bytes(user)
+            password = _to_bytes(password)
+            sz += 2 + len(user) + 2 + len(password)
+            flags |= 0xC0
+        if lw_topic:
+            lw_topic = _to_bytes(lw_topic)
+            lw_msg = _to_bytes(lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+            flags |= 0x4 | (lw_qos & 0x1) << 3 | (lw_qos & 0x2) << 3
+            flags |= lw_retain << 5
+        assert keepalive < 65536
+
+        pos = self._header(0x10, sz)
+        pos = self._str(pos, b"MQTT")
+        struct.pack_into("!BBH", self.buf, pos, 4, flags, keepalive)
+        pos = self._str(pos + 4, client_id)
+        if lw_topic:
+            pos = self._str(pos, lw_topic)
+            pos = self._str(pos, lw_msg)
+        if user is not None:
+            pos = self._str(pos, user)
+            pos = self._str(pos, password)
+        return pos
+
+    def publish(self, topic, msg, retain=False, qos=0, pid=0, dup=False):
+        topic = _to_bytes(topic)
+        msg = _to_bytes(msg)
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        pos = self._header(0x30 | dup << 3 | qos << 1 | retain, sz)
+        pos = self._str(pos, topic)
+        if qos > 0:
+            struct.pack_into("!H", self.buf, pos, pid)
+            pos += 2
+        return self._bytes(pos, msg)
+
+    def subscribe(self, pid, topic, qos=0):
+        return self.subscribe_many(pid, ((topic, qos),))
+
+    def subscribe_many(self, pid, filters):
+        filters = [(_to_bytes(topic), qos) for topic, qos in filters]
+        sz = 2
+        for topic, qos in filters:
+            sz += 2 + len(topic) + 1
+        pos = self._header(0x82, sz)
+        struct.pack_into("!H", self.buf, pos, pid)
+        pos += 2
+        for topic, qos in filters:
+            pos = self._str(pos, topic)
+            self.buf[pos] = qos
+            pos += 1
+        return pos
+
+    def puback(self, pid):
+        pos = self._header(0x40, 2)
+        struct.pack_into("!H", self.buf, pos, pid)
+        return pos + 2
+
 class MQTTClientSimple:
 
+    # How long to wait for a PINGRESP before the connection is declared dead, in ms.
+    PING_TIMEOUT = 10000
+    # Initial size of the receive buffer. It grows if a single packet does not fit.
+    RECV_BUFFER_SIZE = 512
+    # Maximum number of QoS 1 messages waiting for their PUBACK.
+    MAX_INFLIGHT = 4
+    # How long to wait for a PUBACK before the message is sent again with the DUP flag, in ms.
+    RETRY_TIMEOUT = 5000
+    # How long connect() may block on the TCP connection and the CONNACK, in ms.
+    CONNECT_TIMEOUT = 5000
+    # How long a write may block on a full socket buffer, and wait_msg()
+    # and subscribe() wait for the broker by default, in ms.
+    IO_TIMEOUT = 5000
+
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=60,
                  ssl=False, ssl_params={}):
         if port == 0:
@@ -26,6 +148,7 @@ class MQTTClientSimple:
         self.ssl_params = ssl_params
         self.pid = 0
         self.cb = None
+        self.ack_cb = None
         self.user = user
         self.pswd = password
         self.keepalive = keepalive
@@ -33,24 +156,131 @@ class MQTTClientSimple:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self._last_tx = utime.ticks_ms()
+        self._ping_sent = None
+        self._rbuf = bytearray(self.RECV_BUFFER_SIZE)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rlen = 0
+        self._pkt = None
+        self._enc = MQTTEncoder()
+        # pid -> [ticks when sent or None, topic, msg, retain] for unacknowledged QoS 1 messages
+        self.inflight = {}
+        self._timer = asyncio.Event()
+        self._tick_at = utime.ticks_ms()
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    # The socket is non-blocking once connected. Writes block on poll()
+    # whenever it is not ready, at most for IO_TIMEOUT, and raise
+    # DeadlineExceeded after that.
+    def _write(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+        deadline = None
+        while 1:
+            w = self.sock.write(buf, n)
+            if w is None:
+                if deadline is None:
+                    deadline = Deadline(self.IO_TIMEOUT)
+                deadline.poll(self.sock, uselect.POLLOUT, "mqtt write")
+                continue
+            if w >= n:
+                break
+            buf = buf[w:n]
+            n -= w
+        self._last_tx = utime.ticks_ms()
 
-    def _recv_len(self):
-        n = 0
+    # Send the packet the encoder just wrote. The encoder may have
+    # replaced its buffer for it, so it must be looked up afterwards.
+    def _write_packet(self, n):
+        self._write(self._enc.buf, n)
+
+    # Read whatever is available into the receive buffer with a single
+    # readinto(). Consumed packets are dropped from the front first.
+    # Returns False if nothing could be read without blocking. With a
+    # deadline it blocks until something arrives, at most until then.
+    def _fill(self, deadline=None):
+        rem = self._rlen - self._rpos
+        if self._rpos:
+            if rem > self._rpos:
+                self._rbuf[:rem] = bytes(self._rmv[self._rpos : self._rlen])
+            elif rem:
+                self._rbuf[:rem] = self._rmv[self._rpos : self._rlen]
+            self._rpos = 0
+            self._rlen = rem
+        if rem == len(self._rbuf):
+            self._rbuf = self._rbuf + bytearray(rem)
+            self._rmv = memoryview(self._rbuf)
+        while 1:
+            n = self.sock.readinto(self._rmv[rem:])
+            if n is not None:
+                break
+            if deadline is None:
+                return False
+            deadline.poll(self.sock, uselect.POLLIN, "mqtt read")
+        if n == 0:
+            raise OSError(-1)
+        self._rlen += n
+        return True
+
+    # Take the next complete packet off the receive buffer. Returns
+    # the first header byte and a memoryview of the rest of the packet,
+    # or None if no complete packet is buffered yet. The memoryview is
+    # only valid until the buffer is refilled.
+    def _next_packet(self):
+        buf = self._rbuf
+        end = self._rlen
+        i = self._rpos + 1
+        sz = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7f) << sh
+            if i >= end:
+                return None
+            b = buf[i]
+            i += 1
+            sz |= (b & 0x7f) << sh
             if not b & 0x80:
-                return n
+                break
             sh += 7
+        if i + sz > end:
+            return None
+        op = buf[self._rpos]
+        self._rpos = i + sz
+        return op, self._rmv[i : i + sz]
+
+    # Process a packet from _next_packet(). Subscribed messages go to
+    # the callback as memoryviews of topic and message, which are only
+    # valid during the call. Returns the packet type for anything but
+    # PUBLISH and PINGRESP, with the packet body left in self._pkt.
+    def _handle(self, op, body):
+        if op == 0xd0:  # PINGRESP
+            self._ping_sent = None
+            return None
+        if op == 0x40:  # PUBACK
+            pid = body[0] << 8 | body[1]
+            if self.inflight.pop(pid, None) and self.ack_cb:
+                self.ack_cb(pid)
+        if op & 0xf0 != 0x30:
+            self._pkt = body
+            return op
+        topic_len = (body[0] << 8) | body[1]
+        pos = 2 + topic_len
+        if op & 6:
+            pid = body[pos] << 8 | body[pos + 1]
+            pos += 2
+        self.cb(body[2:2 + topic_len], body[pos:])
+        if op & 6 == 2:
+            self._write_packet(self._enc.puback(pid))
+        elif op & 6 == 4:
+            assert 0
 
     def set_callback(self, f):
         self.cb = f
 
+    # f(pid) is called when the PUBACK for a QoS 1 message sent by
+    # publish() arrives.
+    def set_ack_callback(self, f):
+        self.ack_cb = f
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
         assert topic
@@ -59,167 +289,229 @@ class MQTTClientSimple:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def connect(self, clean_session=True):
+    # Connect and wait for the CONNACK, all of it by the deadline,
+    # CONNECT_TIMEOUT from now by default. Raises DeadlineExceeded
+    # after that.
+    def connect(self, clean_session=True, deadline=None):
         if self.sock:
             self.sock.close()
             self.sock = None
+        deadline = deadline or Deadline(self.CONNECT_TIMEOUT)
         self.sock = socket.socket()
         try:
-            addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+            addr = resolver.resolve(self.server, self.port, deadline)
+            deadline.settimeout(self.sock, "mqtt connect")
             self.sock.connect(addr)
             if self.ssl:
                 import ussl
+                deadline.settimeout(self.sock, "mqtt tls")
                 self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-            premsg = bytearray(b"\x10\0\0\0\0\0")
-            msg = bytearray(b"\x04MQTT\x04\x02\0\0")
-
-            sz = 10 + 2 + len(self.client_id)
-            msg[6] = clean_session << 1
-            if self.user is not None:
-                sz += 2 + len(self.user) + 2 + len(self.pswd)
-                msg[6] |= 0xC0
-            if self.keepalive:
-                assert self.keepalive < 65536
-                msg[7] |= self.keepalive >> 8
-                msg[8] |= self.keepalive & 0x00FF
-            if self.lw_topic:
-                sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-                msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-                msg[6] |= self.lw_retain << 5
-
-            i = 1
-            while sz > 0x7f:
-                premsg[i] = (sz & 0x7f) | 0x80
-                sz >>= 7
-                i += 1
-            premsg[i] = sz
-
-            self.sock.write(premsg, i + 2)
-            self.sock.write(msg)
-            self._send_str(self.client_id)
-            if self.lw_topic:
-                self._send_str(self.lw_topic)
-                self._send_str(self.lw_msg)
-            if self.user is not None:
-                self._send_str(self.user)
-                self._send_str(self.pswd)
+            n = self._enc.connect(self.client_id, clean_session, self.keepalive, self.user, self.pswd,
+                                  self.lw_topic, self.lw_msg, self.lw_qos, self.lw_retain)
+            self._ping_sent = None
+            self._write_packet(n)
+            if not self.ssl:
+                # a TLS socket keeps the timeout of the socket it wraps
+                deadline.settimeout(self.sock, "mqtt connack")
             resp = self.sock.read(4)
             assert resp[0] == 0x20 and resp[1] == 0x02
             if resp[3] != 0:
                 raise MQTTException(resp[3])
+            self.sock.setblocking(False)
+            self._rpos = 0
+            self._rlen = 0
+            for pid, entry in self.inflight.items():
+                self._resend(pid, entry)
+        except OSError as e:
+            self.sock.close()
+            raise timed_out(e, "mqtt connect")
         except:
             self.sock.close()
             raise
         return resp[2] & 1
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
+        self._write(b"\xe0\0")
         self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self._write(b"\xc0\0")
+        if self._ping_sent is None:
+            self._ping_sent = self._last_tx
+
+    def _next_pid(self):
+        while 1:
+            self.pid = self.pid % 65535 + 1
+            if self.pid not in self.inflight:
+                return self.pid
+
+    # Send a message of the in-flight table, with the DUP flag if it
+    # was sent before.
+    def _resend(self, pid, entry):
+        dup = entry[0] is not None
+        entry[0] = utime.ticks_ms()
+        self._write_packet(self._enc.publish(entry[1], entry[2], entry[3], 1, pid, dup))
+
+    # Timer tick for keepalive and QoS 1 retransmission. Sends a PINGREQ
+    # only once nothing else has been sent for a whole keepalive period
+    # and raises OSError when the PINGRESP is overdue. Messages without
+    # a PUBACK after RETRY_TIMEOUT are sent again with the DUP flag.
+    # Returns the number of ms until it needs to be called again.
+    def tick(self):
+        now = utime.ticks_ms()
+        left = self._tick(now)
+        self._tick_at = utime.ticks_add(now, left)
+        return left
+
+    def _tick(self, now):
+        left = self.RETRY_TIMEOUT
+        for pid, entry in self.inflight.items():
+            if entry[0] is None:
+                # queued by a subclass, not sent yet
+                continue
+            age = utime.ticks_diff(now, entry[0])
+            if age >= self.RETRY_TIMEOUT:
+                self._resend(pid, entry)
+            else:
+                left = min(left, self.RETRY_TIMEOUT - age)
+        if self._ping_sent is not None:
+            ping_left = self.PING_TIMEOUT - utime.ticks_diff(now, self._ping_sent)
+            if ping_left <= 0:
+                self._ping_sent = None
+                raise OSError(uerrno.ETIMEDOUT)
+            return min(left, ping_left)
+        if self.keepalive:
+            ping_left = self.keepalive * 1000 - utime.ticks_diff(now, self._last_tx)
+            if ping_left <= 0:
+                self.ping()
+                ping_left = self.PING_TIMEOUT
+            left = min(left, ping_left)
+        return left
+
+    # Number of ms until tick() has something to do. Does not send
+    # anything itself.
+    def tick_due(self):
+        return utime.ticks_diff(self._tick_at, utime.ticks_ms())
 
+    # QoS 1 messages do not wait for their PUBACK. They are kept in the
+    # in-flight table until it arrives and retransmitted by tick(), so
+    # msg must not be modified afterwards. Only when MAX_INFLIGHT
+    # messages are unacknowledged does publish() block in wait_msg.
+    # Returns the packet id, or 0 for QoS 0.
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
-        if qos > 0:
-            sz += 2
-        assert sz < 2097152
-        i = 1
-        while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
-        if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+        assert qos < 2, "QoS 2 is not supported"
+        pid = 0
+        if qos:
+            while len(self.inflight) >= self.MAX_INFLIGHT:
+                self.wait_msg()
+            pid = self._next_pid()
+        self._write_packet(self._enc.publish(topic, msg, retain, qos, pid))
+        if qos:
+            self.inflight[pid] = [self._last_tx, topic, msg, retain]
+            self._tick_at = self._last_tx
+            self._timer.set()
+        return pid
 
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
+        pid = self._next_pid()
+        self._write_packet(self._enc.subscribe(pid, topic, qos))
+        deadline = Deadline(self.IO_TIMEOUT)
         while 1:
-            op = self.wait_msg()
+            op = self.wait_msg(deadline)
             if op == 0x90:
-                resp = self.sock.read(4)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                resp = self._pkt
+                assert resp[0] << 8 | resp[1] == pid
+                if resp[2] == 0x80:
+                    raise MQTTException(resp[2])
                 return
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
-    # messages processed internally.
-    def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return None
-        op = res[0]
-        if op & 0xf0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
+    # messages processed internally. Waits until the deadline,
+    # IO_TIMEOUT from now by default, and raises DeadlineExceeded if
+    # no complete packet arrived by then.
+    def wait_msg(self, deadline=None):
+        while 1:
+            pkt = self._next_packet()
+            if pkt:
+                return self._handle(*pkt)
+            if not self._fill():
+                if deadline is None:
+                    deadline = Deadline(self.IO_TIMEOUT)
+                self._fill(deadline)
 
-    # Checks whether a pending message from server is available.
-    # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # Reads whatever the server has sent so far without blocking and
+    # processes every complete packet in it. Partial packets are kept
+    # for the next call. Returns the type of the last packet processed
+    # as wait_msg would, or None.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        op = None
+        pkt = self._next_packet()
+        if not pkt and self._fill():
+            pkt = self._next_packet()
+        while pkt:
+            op = self._handle(*pkt)
+            pkt = self._next_packet()
+        return op
+
+    # Awaitable counterpart of wait_msg for uasyncio tasks. Suspends
+    # the calling task until the socket is readable, then does the
+    # same processing as check_msg.
+    async def await_msg(self):
+        await wait_readable(self.sock)
+        return self.check_msg()
 
+    # Awaitable counterpart of tick. Sleeps until tick is due again or
+    # publish() adds a message to the in-flight table.
+    async def await_tick(self):
+        self._timer.clear()
+        try:
+            await wait_for_ms(self._timer.wait(), self.tick())
+        except asyncio.TimeoutError:
+            pass
+
+# MQTTClient connection states
+DISCONNECTED = 0
+CONNECTING = 1
+WAIT_CONNACK = 2
+CONNECTED = 3
+
+# Keeps itself connected without blocking the caller. start() begins
+# connecting and run(), a uasyncio task, drives the connection: a
+# non-blocking TCP connect and the CONNACK are each bounded by
+# CONNECT_TIMEOUT, and after a failure or a lost connection the next
+# attempt waits a jittered, exponentially growing delay. Topics are
+# subscribed again whenever the broker did not keep the session.
+#
+# QoS 1 messages are queued while the connection is down, or while
+# MAX_INFLIGHT messages are waiting for their PUBACK, and sent as soon
+# as possible. At most MAX_QUEUED are kept, the oldest unsent one is
+# dropped beyond that. QoS 0 messages are dropped while disconnected.
 class MQTTClient(MQTTClientSimple):
 
-    DELAY = 2
+    BACKOFF_MIN = 1000
+    BACKOFF_MAX = 60000
+    MAX_QUEUED = 16
     DEBUG = False
 
-    def delay(self, i):
-        utime.sleep(self.DELAY)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state = DISCONNECTED
+        self.failures = 0
+        # connections established so far, every one after the first is a reconnect
+        self.connects = 0
+        # topic -> qos
+        self.subscriptions = {}
+        # pids of QoS 1 messages in the in-flight table not sent yet, oldest first
+        self._queue = []
+        self._clean_session = True
+        # when the next connection attempt is due, None before start()
+        self._deadline = None
+        # the Deadline of the attempt in progress
+        self._attempt = None
+        self._up = asyncio.Event()
 
     def log(self, in_reconnect, e):
         if self.DEBUG:
@@ -228,28 +520,336 @@ class MQTTClient(MQTTClientSimple):
             else:
                 print("mqtt: %r" % e)
 
-    def reconnect(self):
-        i = 0
-        while 1:
+    def isconnected(self):
+        return self.state == CONNECTED
+
+    async def wait_connected(self):
+        await self._up.wait()
+
+    def start(self, clean_session=True):
+        self._clean_session = clean_session
+        self._deadline = utime.ticks_ms()
+        self._timer.set()
+
+    def _open(self):
+        addr = resolver.resolve(self.server, self.port, self._attempt)
+        self.sock = socket.socket()
+        self.sock.setblocking(False)
+        try:
+            self.sock.connect(addr)
+        except OSError as e:
+            if e.args[0] != uerrno.EINPROGRESS:
+                raise
+
+    def _handshake(self):
+        if self.ssl:
+            import ussl
+            self._attempt.settimeout(self.sock, "mqtt tls")
             try:
-                return super().connect(False)
+                self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
             except OSError as e:
-                self.log(True, e)
-                i += 1
-                self.delay(i)
+                raise timed_out(e, "mqtt tls")
+            self.sock.setblocking(False)
+        self._rpos = 0
+        self._rlen = 0
+        self._ping_sent = None
+        self._write_packet(self._enc.connect(
+            self.client_id, self._clean_session, self.keepalive, self.user, self.pswd,
+            self.lw_topic, self.lw_msg, self.lw_qos, self.lw_retain))
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        while 1:
+    # Advance the connection state machine. Raises OSError or
+    # MQTTException when the attempt failed. Returns the number of ms
+    # until it needs to be called again.
+    def _connecting(self, now):
+        if self._deadline is None:
+            return self.BACKOFF_MAX
+        expired = utime.ticks_diff(self._deadline, now) <= 0
+        if self.state == DISCONNECTED:
+            if not expired:
+                return utime.ticks_diff(self._deadline, now)
+            self._attempt = Deadline(self.CONNECT_TIMEOUT)
+            self._deadline = self._attempt.at
+            self._open()
+            self.state = CONNECTING
+            expired = False
+        if self.state == CONNECTING:
+            poller = uselect.poll()
+            poller.register(self.sock, uselect.POLLOUT)
+            res = poller.poll(0)
+            if not res:
+                if expired:
+                    raise OSError(uerrno.ETIMEDOUT)
+                return 50
+            if res[0][1] & (uselect.POLLERR | uselect.POLLHUP):
+                raise OSError(uerrno.ECONNREFUSED)
+            self._handshake()
+            self.state = WAIT_CONNACK
+        # The CONNACK comes first, but messages the broker kept for the
+        # session may follow in the same read. They are handled once
+        # the connection is established.
+        pkt = self._next_packet()
+        if not pkt and self._fill():
+            pkt = self._next_packet()
+        if pkt:
+            if pkt[0] != 0x20:
+                raise MQTTException("expected CONNACK, got packet type %d" % (pkt[0] >> 4))
+            self._established(pkt[1])
+            if self.state == CONNECTED:
+                self.check_msg()
+            return 0
+        if expired:
+            raise OSError(uerrno.ETIMEDOUT)
+        return 50
+
+    def _established(self, connack):
+        if connack[1] != 0:
+            raise MQTTException(connack[1])
+        session_present = connack[0] & 1
+        self.state = CONNECTED
+        self.failures = 0
+        self.connects += 1
+        self._clean_session = False
+        if self.DEBUG:
+            print("mqtt connected, session present:", session_present)
+        if not session_present and self.subscriptions:
+            self._write_packet(self._enc.subscribe_many(self._next_pid(), self.subscriptions.items()))
+        for pid, entry in self.inflight.items():
+            if entry[0] is not None:
+                self._resend(pid, entry)
+        self._send_queued()
+        if self.state == CONNECTED:
+            self._up.set()
+
+    def _lost(self, e):
+        self.log(True, e)
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        self.state = DISCONNECTED
+        self._up.clear()
+        self._ping_sent = None
+        self.failures += 1
+        # "equal jitter": half of the delay is fixed, the other half random
+        delay = min(self.BACKOFF_MIN << min(self.failures - 1, 16), self.BACKOFF_MAX)
+        delay = delay // 2 + urandom.getrandbits(16) % (delay // 2 + 1)
+        self._deadline = utime.ticks_add(utime.ticks_ms(), delay)
+        if self.DEBUG:
+            print("mqtt connection attempt", self.failures, "in", delay, "ms")
+
+    def _send_queued(self):
+        # Send queued messages while the in-flight window has room.
+        if self.state != CONNECTED:
+            return
+        while self._queue and len(self.inflight) - len(self._queue) < self.MAX_INFLIGHT:
+            pid = self._queue.pop(0)
             try:
-                return super().publish(topic, msg, retain, qos)
+                self._resend(pid, self.inflight[pid])
             except OSError as e:
-                self.log(False, e)
-            self.reconnect()
+                self._lost(e)
+                return
+            self._tick_at = self._last_tx
+            self._timer.set()
+
+    def _handle(self, op, body):
+        if op == 0x90:  # SUBACK
+            for i in range(2, len(body)):
+                if body[i] == 0x80:
+                    print("mqtt subscription", i - 1, "refused")
+        res = super()._handle(op, body)
+        if op == 0x40:
+            self._send_queued()
+        return res
+
+    def subscribe(self, topic, qos=0):
+        self.subscribe_many(((topic, qos),))
+
+    # Subscribe to several (topic filter, qos) pairs with a single
+    # SUBSCRIBE packet.
+    def subscribe_many(self, filters):
+        assert self.cb is not None, "Subscribe callback is not set"
+        filters = [(_to_bytes(topic), qos) for topic, qos in filters]
+        for topic, qos in filters:
+            self.subscriptions[topic] = qos
+        if filters and self.state == CONNECTED:
+            try:
+                self._write_packet(self._enc.subscribe_many(self._next_pid(), filters))
+            except OSError as e:
+                self._lost(e)
 
+    def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2, "QoS 2 is not supported"
+        if not qos:
+            if self.state == CONNECTED:
+                try:
+                    super().publish(topic, msg, retain)
+                except OSError as e:
+                    self._lost(e)
+            elif self.DEBUG:
+                print("mqtt not connected, dropping message for", topic)
+            return 0
+        if len(self._queue) >= self.MAX_QUEUED:
+            dropped = self._queue.pop(0)
+            print("mqtt queue full, dropping message for", self.inflight.pop(dropped)[1])
+        pid = self._next_pid()
+        self.inflight[pid] = [None, topic, msg, retain]
+        self._queue.append(pid)
+        self._send_queued()
+        return pid
+
+    def check_msg(self):
+        if self.state != CONNECTED:
+            return None
+        try:
+            return super().check_msg()
+        except OSError as e:
+            self._lost(e)
+
+    # Waits no longer than until tick() is due again, so the connection
+    # is kept alive meanwhile.
     def wait_msg(self):
         while 1:
+            left = self.tick()
+            if self.state != CONNECTED:
+                utime.sleep_ms(left)
+                continue
+            deadline = Deadline(left)
             try:
-                return super().wait_msg()
+                return super().wait_msg(deadline)
+            except DeadlineExceeded as e:
+                # only a write that timed out ends before the deadline
+                if deadline.remaining():
+                    self._lost(e)
             except OSError as e:
-                self.log(False, e)
-            self.reconnect()
+                self._lost(e)
+
+    def tick(self):
+        now = utime.ticks_ms()
+        try:
+            if self.state == CONNECTED:
+                left = self._tick(now)
+            else:
+                left = self._connecting(now)
+        except (OSError, MQTTException) as e:
+            self._lost(e)
+            left = utime.ticks_diff(self._deadline, now)
+        self._tick_at = utime.ticks_add(now, left)
+        return left
+
+    # Drive the connection forever. Waits for incoming packets while
+    # connected, and otherwise until tick() is due or start() or
+    # publish() wake it up.
+    async def run(self):
+        while 1:
+            left = self.tick()
+            self._timer.clear()
+            if self.state == CONNECTED:
+                try:
+                    await wait_for_ms(wait_readable(self.sock), left)
+                except asyncio.TimeoutError:
+                    continue
+                self.check_msg()
+            else:
+                try:
+                    await wait_for_ms(self._timer.wait(), left)
+                except asyncio.TimeoutError:
+                    pass
+
+
+class _Node:
+    def __init__(self):
+        # byte value -> _Node for the literal bytes of a level and the "/" between levels
+        self.next = {}
+        # _Node at the end of a level matched by "+"
+        self.plus = None
+        # handlers of a "#" filter starting at this level
+        self.hash = []
+        # handlers of filters ending here
+        self.handlers = []
+
+# Dispatches incoming messages to handlers by topic filter. The filters
+# are compiled into a trie over the raw bytes of the topic, so matching
+# walks the received topic in place without decoding or splitting it.
+# Handlers are called as handler(topic, msg) with memoryviews that are
+# only valid during the call; a topic matching several filters calls
+# each of their handlers. Install it with set_callback(router.dispatch)
+# and subscribe all filters at once with router.subscribe(client).
+class Router:
+
+    def __init__(self, default=None):
+        self._root = _Node()
+        # called with topic and msg for messages no filter matched
+        self.default = default
+        self.filters = []
+
+    def add(self, topic_filter, handler, qos=0):
+        topic_filter = _to_bytes(topic_filter)
+        levels = topic_filter.split(b"/")
+        node = self._root
+        for i, level in enumerate(levels):
+            if i:
+                node = node.next.setdefault(0x2f, _Node())
+            if level == b"#":
+                if i != len(levels) - 1:
+                    raise ValueError("# must be the last level")
+                node.hash.append(handler)
+                break
+            if level == b"+":
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+                continue
+            if b"+" in level or b"#" in level:
+                raise ValueError("wildcards must fill a whole level")
+            for b in level:
+                child = node.next.get(b)
+                if child is None:
+                    child = node.next[b] = _Node()
+                node = child
+        else:
+            node.handlers.append(handler)
+        self.filters.append((topic_filter, qos))
+
+    def subscribe(self, client):
+        client.subscribe_many(self.filters)
+
+    def dispatch(self, topic, msg):
+        # Topics starting with "$" are not matched by wildcards at the first level.
+        n = len(topic)
+        if not self._level(self._root, topic, msg, 0, n, n and topic[0] == 0x24) and self.default:
+            self.default(topic, msg)
+
+    # node is at the start of the level beginning at topic[i]. Returns
+    # the number of handlers called.
+    def _level(self, node, topic, msg, i, n, no_wildcards=False):
+        count = 0
+        if not no_wildcards:
+            for handler in node.hash:
+                handler(topic, msg)
+                count += 1
+            if node.plus:
+                j = i
+                while j < n and topic[j] != 0x2f:
+                    j += 1
+                count += self._end(node.plus, topic, msg, j, n)
+        while i < n and topic[i] != 0x2f:
+            node = node.next.get(topic[i])
+            if node is None:
+                return count
+            i += 1
+        return count + self._end(node, topic, msg, i, n)
+
+    # node is at the end of a level ending at topic[j].
+    def _end(self, node, topic, msg, j, n):
+        sep = node.next.get(0x2f)
+        if j < n:
+            return self._level(sep, topic, msg, j + 1, n) if sep else 0
+        count = 0
+        for handler in node.handlers:
+            handler(topic, msg)
+            count += 1
+        # "a/#" also matches "a"
+        if sep:
+            for handler in sep.hash:
+                handler(topic, msg)
+                count += 1
+        return count
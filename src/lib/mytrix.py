@@ -14,24 +14,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import ntptime
+import httpclient
+import jsonstream
 import re
-import urequests
+import utime
+from deadline import Deadline
+from aio import asyncio, sleep_ms, wait_for_ms
+
+class MatrixError(RuntimeError):
+    """A non-2xx response of the homeserver.
+
+    The errcode and retry_after_ms fields of the error response are None if the homeserver did not
+    send them.
+    """
+
+    def __init__(self, status_code, reason, data):
+        super().__init__(reason + ":" + str(data))
+        self.status_code = status_code
+        if not isinstance(data, dict):
+            data = {}
+        self.errcode = data.get("errcode")
+        self.retry_after_ms = data.get("retry_after_ms")
 
 class Matrix:
     """Implements Matrix client functionality and state keeping"""
 
-    sync_limit = 1
-
-    def __init__(self, homeserver=None, matrix_id=None, access_token=None, username=None, password=None, txn_id=None):
+    sync_limit = 50
+    lazy_login = False
+    # how long a request may take, in ms, before it fails with deadline.DeadlineExceeded
+    request_timeout = 5000
+
+    # the parts of a /messages response kept by get_room_messages, see jsonstream
+    messages_select = {
+        "chunk": [{
+            "type": True,
+            "event_id": True,
+            "room_id": True,
+            "sender": True,
+            "content": {"msgtype": True, "body": True},
+        }],
+        "start": True,
+        "end": True,
+    }
+
+    def __init__(self, homeserver=None, matrix_id=None, access_token=None, username=None, password=None, txn_id=None, txn_ids=None):
         """Configure the Matrix client.
 
         The arguments homeserver, matrix_id and access_token configure access to the Matrix network.
         See the Matrix documentation for details.
 
-        The txn_id argument is optional and takes the transaction id to start with. If left out,
-        if defaults to the current UNIX timestamp, retrieved by an NTP request. For details on transaction
-        IDs, see the Matrix documentation.
+        Transaction ids are taken from txn_ids, an object whose next() method returns a new id on every
+        call, e.g. a storage.Sequence that keeps them unique across resets. Without it, they are counted
+        from txn_id, which defaults to the current UNIX timestamp of the RTC. That is only unique if the
+        clock is set and nothing was sent in the same second before a restart. For details on
+        transaction IDs, see the Matrix documentation.
         """
         self.homeserver = homeserver
         self.matrix_id = matrix_id
@@ -42,17 +78,18 @@ class Matrix:
         if not self.access_token:
             if not username or not password:
                 raise TypeError("if no access_token is given then username and password musst be provided")
-            self.login(username, password)
+        self._credentials = (username, password)
 
-        if txn_id is None:
-            self._txn_id = ntptime.time()
-        else:
-            self._txn_id = txn_id
+        self._txn_ids = txn_ids
+        self._txn_id = utime.time() if txn_id is None else txn_id
 
         self._from_cache = {}
 
-    def _request(self, method, endpoint, query_data=None, json_data=None, unauth=False):
-        """Send an HTTP request using urequests."""
+        if not self.access_token and not self.lazy_login:
+            self.login(username, password)
+
+    def _prepare_request(self, endpoint, query_data=None, unauth=False):
+        """Build the URL and headers for a request to the client API."""
         url = "%s/_matrix/client%s" % (self.homeserver, endpoint)
 
         if query_data:
@@ -63,7 +100,10 @@ class Matrix:
         if not unauth:
             headers["Authorization"] = "Bearer %s" % (self.access_token,)
 
-        res = method(url, json=json_data, headers=headers)
+        return url, headers
+
+    def _handle_response(self, res):
+        """Decode a response, raising MatrixError for non-2xx status codes."""
         try:
             data = res.json()
         except:
@@ -71,22 +111,38 @@ class Matrix:
         if 200 <= res.status_code < 300:
             return data
         else:
-            raise RuntimeError(res.reason.decode() + ":" + str(data))
+            raise MatrixError(res.status_code, res.reason.decode(), data)
+
+    def _request(self, method, endpoint, query_data=None, json_data=None, unauth=False, select=None):
+        """Send an HTTP request over a pooled keep-alive connection.
+
+        If select is given, the response is parsed while it is received and only the selected parts
+        of it are returned, see jsonstream.
+        """
+        url, headers = self._prepare_request(endpoint, query_data, unauth)
+        parser = jsonstream.Parser(select) if select else None
+
+        res = httpclient.pool.request(
+            method, url, json=json_data, headers=headers, parser=parser, deadline=Deadline(self.request_timeout)
+        )
+        return self._handle_response(res)
 
     def _put(self, endpoint, query_data=None, json_data=None, unauth=False):
-        """Send a PUT request using urequests."""
-        return self._request(urequests.put, endpoint, query_data, json_data, unauth)
+        """Send a PUT request."""
+        return self._request("PUT", endpoint, query_data, json_data, unauth)
 
     def _post(self, endpoint, query_data=None, json_data=None, unauth=False):
-        """Send a POST request using urequests."""
-        return self._request(urequests.post, endpoint, query_data, json_data, unauth)
+        """Send a POST request."""
+        return self._request("POST", endpoint, query_data, json_data, unauth)
 
-    def _get(self, endpoint, query_data=None, unauth=False):
-        """Send a GET request using urequests."""
-        return self._request(urequests.get, endpoint, query_data, unauth)
+    def _get(self, endpoint, query_data=None, unauth=False, select=None):
+        """Send a GET request."""
+        return self._request("GET", endpoint, query_data, unauth=unauth, select=select)
 
     @property
     def txn_id(self):
+        if self._txn_ids:
+            return self._txn_ids.next()
         txn_id_cur = self._txn_id
         self._txn_id += 1
         return txn_id_cur
@@ -104,9 +160,15 @@ class Matrix:
         else:
             raise RuntimeError("Login failed")
 
-    def send_room_event(self, room, type_, content):
-        """Send and arbitrary event to a room."""
-        endpoint = "/r0/rooms/%s/send/%s/%s" % (room, type_, self.txn_id)
+    def send_room_event(self, room, type_, content, txn_id=None):
+        """Send and arbitrary event to a room.
+
+        The txn_id argument is optional. Pass the same transaction id again when retrying a send,
+        so the homeserver can deduplicate it.
+        """
+        if txn_id is None:
+            txn_id = self.txn_id
+        endpoint = "/r0/rooms/%s/send/%s/%s" % (room, type_, txn_id)
 
         return self._put(endpoint, json_data=content)
 
@@ -121,20 +183,20 @@ class Matrix:
         endpoint = "/r0/profile/%s/displayname" % (self.matrix_id,)
         content = {"displayname": nick}
 
-        self._put(endpoint, json_data=content)
+        return self._put(endpoint, json_data=content)
 
     def set_avatar(self, avatar_url):
         """Set the account's avatar by MXC URL."""
         endpoint = "/r0/profile/%s/avatar_url" % (self.matrix_id,)
         content = {"avatar_url": avatar_url}
 
-        self._put(endpoint, json_data=content)
+        return self._put(endpoint, json_data=content)
 
-    def send_room_message(self, room, text, msgtype="m.text"):
+    def send_room_message(self, room, text, msgtype="m.text", txn_id=None):
         """Send a message event to a room."""
         content = {"msgtype": "m.text", "body": text}
 
-        return self.send_room_event(room, "m.room.message", content)
+        return self.send_room_event(room, "m.room.message", content, txn_id)
 
     def send_dm_message(self, mxid, text, msgtype="m.text"):
         """Send a message event to a DM room, discovering or creating it beforehand."""
@@ -151,10 +213,18 @@ class Matrix:
         next events since the last call.
 
         The limit_ argument defaults to the sync_limit attribute of the Matrix instance, which by
-        default is 1. This is to not get out-of-memory conditions if some events are big.
+        default is 50. The response is parsed while it is received and only the fields named in the
+        messages_select attribute are kept, so big events do not cause out-of-memory conditions.
 
         For all other arguments, see the Matrix documentation.
         """
+        endpoint, query_data = self._messages_query(room, from_, dir_, limit)
+        data = self._get(endpoint, query_data, select=self.messages_select)
+        self._remember_token(room, data)
+        return data
+
+    def _messages_query(self, room, from_, dir_, limit):
+        """Build the endpoint and query of a /messages request, see get_room_messages."""
         if limit is None:
             limit = self.sync_limit
         if from_ is None:
@@ -168,16 +238,15 @@ class Matrix:
         }
         if from_:
             query_data["from"] = str(from_)
+        return endpoint, query_data
 
-        data = self._get(endpoint, query_data)
-
+    def _remember_token(self, room, data):
+        """Store the token the next get_room_messages call continues from."""
         if "end" in data:
             self._from_cache[room] = data["end"]
         elif "start" in data:
             self._from_cache[room] = data["start"]
 
-        return data
-
     def get_dm_messages(self, mxid, from_=None, dir_="f", limit=None):
         """Get messages in a DM room, discovering or creating it beforehand."""
         room = self.get_dm_room(mxid)
@@ -198,12 +267,21 @@ class Matrix:
 
         The method returns a list of all matched messages.
         """
-        data = self.get_room_messages(room)
+        return self._react(self.get_room_messages(room), cases, regex)
+
+    def _react(self, data, cases, regex):
+        """Trigger the callbacks for the messages of a /messages response, see react_room_messages."""
         matches = []
 
         for event in data.get("chunk", []):
-            if event["type"] == "m.room.message" and event["content"]["msgtype"] == "m.text":
-                message = event["content"]["body"]
+            # content is a dict or missing, the parser drops it otherwise, see messages_select
+            content = event.get("content", {})
+            message = content.get("body")
+            if (
+                event.get("type") == "m.room.message"
+                and content.get("msgtype") == "m.text"
+                and isinstance(message, str)
+            ):
                 for key_, func in cases.items():
                     if regex:
                         finds = re.search(key_, message)
@@ -234,14 +312,14 @@ class Matrix:
     def set_account_data(self, type_, content):
         """Set the account data of the given type."""
         endpoint = "/r0/user/%s/account_data/%s" % (self.matrix_id, type_)
-        res = self._put(endpoint, json_data=content)
+        return self._put(endpoint, json_data=content)
 
     def _create_dm_room(self, mxid, dm_rooms=None):
         """Create a DM chat with the given matrix ID."""
         endpoint = "/r0/createRoom"
         content = {"preset": "trusted_private_chat", "invite": [mxid], "is_direct": True}
 
-        res = self._post(endpoint, json=content)
+        res = self._post(endpoint, json_data=content)
         room_id = res["room_id"]
 
         if dm_rooms is None:
@@ -262,3 +340,295 @@ class Matrix:
             return dm_rooms[mxid][0]
 
         return self._create_dm_room(mxid, dm_rooms)
+
+
+class AsyncMatrix(Matrix):
+    """Matrix client for use from uasyncio tasks.
+
+    Requests suspend only the calling task while waiting for the homeserver, so every method that
+    sends a request returns an awaitable instead, and the methods that make several requests or use
+    the result of one are coroutines of their own. If no access token is given, the
+    first request logs in, or await ensure_login() to do so right away.
+    """
+
+    lazy_login = True
+
+    async def _request(self, method, endpoint, query_data=None, json_data=None, unauth=False, select=None):
+        """Send an HTTP request over a pooled keep-alive connection.
+
+        Logs in first if there is no access token. If the homeserver rejects the access token, it is
+        dropped, so the next request logs in again with the configured username and password.
+        """
+        if not unauth:
+            await self.ensure_login()
+        url, headers = self._prepare_request(endpoint, query_data, unauth)
+        parser = jsonstream.Parser(select) if select else None
+
+        res = await httpclient.pool.await_request(
+            method, url, json=json_data, headers=headers, parser=parser, deadline=Deadline(self.request_timeout)
+        )
+        if res.status_code == 401 and not unauth and self._credentials[0]:
+            self.access_token = None
+        return self._handle_response(res)
+
+    async def login(self, username, password):
+        """Login to homeserver using username and password."""
+        endpoint = "/r0/login"
+        json_data = {"user": username, "password": password, "type": "m.login.password"}
+
+        data = await self._post(endpoint, json_data=json_data, unauth=True)
+
+        if "access_token" in data:
+            self.access_token = data["access_token"]
+            return True
+        else:
+            raise RuntimeError("Login failed")
+
+    async def ensure_login(self):
+        """Log in with the configured username and password unless an access token is set."""
+        if not self.access_token:
+            await self.login(*self._credentials)
+
+    async def send_dm_message(self, mxid, text, msgtype="m.text"):
+        """Send a message event to a DM room, discovering or creating it beforehand."""
+        room = await self.get_dm_room(mxid)
+        return await self.send_room_message(room, text, msgtype)
+
+    async def get_room_messages(self, room, from_=None, dir_="f", limit=None):
+        """Get message events for a room, see Matrix.get_room_messages."""
+        endpoint, query_data = self._messages_query(room, from_, dir_, limit)
+        data = await self._get(endpoint, query_data, select=self.messages_select)
+        self._remember_token(room, data)
+        return data
+
+    async def get_dm_messages(self, mxid, from_=None, dir_="f", limit=None):
+        """Get messages in a DM room, discovering or creating it beforehand."""
+        room = await self.get_dm_room(mxid)
+        return await self.get_room_messages(room, from_, dir_, limit)
+
+    async def react_room_messages(self, room, cases, regex=False):
+        """Get room messages and trigger callbacks, see Matrix.react_room_messages."""
+        return self._react(await self.get_room_messages(room), cases, regex)
+
+    async def react_dm_messages(self, mxid, cases):
+        """Get DM messages and trigger callbacks."""
+        room = await self.get_dm_room(mxid)
+        return await self.react_room_messages(room, cases)
+
+    async def set_account_data(self, type_, content):
+        """Set the account data of the given type."""
+        endpoint = "/r0/user/%s/account_data/%s" % (self.matrix_id, type_)
+        return await self._put(endpoint, json_data=content)
+
+    async def _create_dm_room(self, mxid, dm_rooms=None):
+        """Create a DM chat with the given matrix ID."""
+        endpoint = "/r0/createRoom"
+        content = {"preset": "trusted_private_chat", "invite": [mxid], "is_direct": True}
+
+        res = await self._post(endpoint, json_data=content)
+        room_id = res["room_id"]
+
+        if dm_rooms is None:
+            dm_rooms = await self.get_account_data("m.direct")
+        dm_rooms.setdefault(mxid, []).append(room_id)
+        await self.set_account_data("m.direct", dm_rooms)
+
+        return room_id
+
+    async def get_dm_room(self, mxid):
+        """Get the (first) DM room for a target Matrix ID, creating it if there is none."""
+        dm_rooms = await self.get_account_data("m.direct")
+        if mxid in dm_rooms and len(dm_rooms[mxid]) > 0:
+            return dm_rooms[mxid][0]
+
+        return await self._create_dm_room(mxid, dm_rooms)
+
+
+class Outbox:
+    """Bounded queue of room messages waiting to be sent, scheduled to stay within rate limits.
+
+    Messages are queued with put(), which never touches the network. The run() coroutine delivers them
+    through an AsyncMatrix client and sleeps while nothing is due. Messages to the same room are sent
+    in the order they were queued, while a room whose send keeps failing does not hold up the others.
+
+    Sends are paced by a token bucket: up to burst messages go out at once, then one every
+    send_interval ms. When the homeserver answers 429, nothing is sent until its retry_after_ms has
+    passed, without counting it as a failed attempt. A send failing with a 5xx status or a network
+    error is retried with an increasing delay, reusing its transaction id, and given up after
+    max_attempts. Other 4xx errors are not retried, except a 403 M_FORBIDDEN if a rejoin coroutine
+    function is given: the homeserver answers so once we were kicked from the room or left it, so
+    rejoin(room) is awaited and the send is retried like after a network error. When the queue is full,
+    the oldest message is dropped.
+
+    A queued message is superseded by the next one put for the same room, unless it is being sent
+    already. If a storage.Journal is given, queued messages are recorded in it and queued again after
+    a reset.
+    """
+
+    def __init__(self, matrix, size=8, retry_delay=2000, max_retry_delay=60000, max_attempts=10, journal=None,
+                 burst=3, send_interval=1000, rejoin=None):
+        self.matrix = matrix
+        self.size = size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.journal = journal
+        self.burst = burst
+        self.send_interval = send_interval
+        self.rejoin = rejoin
+
+        now = utime.ticks_ms()
+        # [room, text, txn_id, failed attempts, ticks of the next attempt], oldest first
+        self._queue = []
+        self._sending = None
+        self._tokens = burst
+        self._refilled = now
+        # no sends before this while the homeserver rate limits us
+        self._hold = now
+        self._ready = asyncio.Event()
+
+        if journal:
+            for room, (text, txn_id) in journal.pending("matrix"):
+                print("matrix outbox restored message for", room)
+                self._queue.append([room, text, txn_id, 0, now])
+            self._queue = self._queue[-size:]
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _token_wait(self, now):
+        # Refill the bucket and return the number of ms until a token is available.
+        if self._tokens >= self.burst:
+            self._refilled = now
+            return 0
+        refills = utime.ticks_diff(now, self._refilled) // self.send_interval
+        if refills > 0:
+            self._tokens = min(self.burst, self._tokens + refills)
+            self._refilled = utime.ticks_add(self._refilled, refills * self.send_interval)
+        if self._tokens > 0:
+            return 0
+        return utime.ticks_diff(utime.ticks_add(self._refilled, self.send_interval), now)
+
+    def _next(self, now):
+        # The message to send next and the number of ms until it may be sent, or (None, None).
+        rooms = []
+        best = None
+        wait = None
+        for entry in self._queue:
+            if entry[0] in rooms:
+                # only the oldest message of a room can be sent
+                continue
+            rooms.append(entry[0])
+            left = utime.ticks_diff(entry[4], now)
+            if wait is None or left < wait:
+                best = entry
+                wait = left
+        if best is None:
+            return None, None
+        wait = max(wait, utime.ticks_diff(self._hold, now), self._token_wait(now), 0)
+        return best, wait
+
+    def due_in(self):
+        """Number of ms until the next send attempt, 0 while sending, or None if the queue is empty."""
+        if self._sending is not None:
+            return 0
+        return self._next(utime.ticks_ms())[1]
+
+    def put(self, room, text):
+        """Queue a text message for a room, superseding the one still queued for it."""
+        for i in range(len(self._queue)):
+            if self._queue[i][0] == room and self._queue[i] is not self._sending:
+                self._queue.pop(i)
+                break
+        if len(self._queue) >= self.size:
+            for entry in self._queue:
+                if entry is not self._sending:
+                    print("matrix outbox full, dropping message for", entry[0])
+                    self._remove(entry)
+                    break
+        txn_id = self.matrix.txn_id
+        self._queue.append([room, text, txn_id, 0, utime.ticks_ms()])
+        if self.journal:
+            self.journal.set("matrix", room, [text, txn_id])
+        self._ready.set()
+
+    def _remove(self, entry):
+        # Remove a message once it was delivered or given up.
+        for i in range(len(self._queue)):
+            if self._queue[i] is entry:
+                self._queue.pop(i)
+                break
+        if self.journal:
+            for queued in self._queue:
+                if queued[0] == entry[0]:
+                    break
+            else:
+                self.journal.clear("matrix", entry[0])
+
+    def _failed(self, entry, e):
+        entry[3] += 1
+        if entry[3] >= self.max_attempts:
+            print("matrix send to", entry[0], "failed, giving up:", e)
+            self._remove(entry)
+            return
+        delay = min(self.retry_delay << (entry[3] - 1), self.max_retry_delay)
+        entry[4] = utime.ticks_add(utime.ticks_ms(), delay)
+        print("matrix send to", entry[0], "failed, retrying in", delay, "ms:", e)
+
+    async def step(self):
+        """Send the next message once it is due. Returns True if a message was delivered.
+
+        Returns False without sending if the queue changed while waiting, call it again then.
+        """
+        entry, wait = self._next(utime.ticks_ms())
+        if entry is None:
+            return False
+        if wait > 0:
+            # a message put meanwhile may be due earlier
+            self._ready.clear()
+            try:
+                await wait_for_ms(self._ready.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            return False
+
+        self._tokens -= 1
+        self._sending = entry
+        room, text, txn_id = entry[0], entry[1], entry[2]
+        try:
+            await self.matrix.send_room_message(room, text, txn_id=txn_id)
+        except MatrixError as e:
+            if e.status_code == 429:
+                delay = e.retry_after_ms or self.retry_delay
+                self._hold = utime.ticks_add(utime.ticks_ms(), delay)
+                print("matrix rate limit reached, pausing sends for", delay, "ms")
+            elif e.status_code == 403 and e.errcode == "M_FORBIDDEN" and self.rejoin:
+                print("matrix send to", room, "forbidden, joining the room again")
+                try:
+                    await self.rejoin(room)
+                except Exception as join_error:
+                    e = join_error
+                self._failed(entry, e)
+            elif 400 <= e.status_code < 500 and e.status_code != 401:
+                print("matrix send to", room, "rejected, giving up:", e)
+                self._remove(entry)
+            else:
+                self._failed(entry, e)
+            return False
+        except Exception as e:
+            self._failed(entry, e)
+            return False
+        finally:
+            self._sending = None
+
+        self._remove(entry)
+        return True
+
+    async def run(self):
+        """Deliver queued messages forever."""
+        while True:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            await self.step()
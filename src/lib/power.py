@@ -0,0 +1,60 @@
+# Low-power idling between events.
+#
+# When every task is waiting for a deadline or for input, the board does not need to run at full
+# clock. Power.sleep() is called with the time until the next deadline and the streams that may wake
+# it up early, and either
+# * "freq": lowers the CPU frequency and blocks in poll() on those streams until one of them is
+#   ready or the deadline is reached, or
+# * "lightsleep": enters machine.lightsleep() until the deadline, waking early only on pins that
+#   were set up as wake sources. Sockets are not wake sources, so max_sleep_ms bounds how late
+#   network traffic is handled.
+
+import machine
+import uselect
+import utime
+
+
+class Power:
+    """Sleeps until the next deadline and counts the time spent asleep and awake."""
+
+    def __init__(self, mode=None, idle_freq=80000000, min_sleep_ms=20, max_sleep_ms=1000):
+        if mode not in (None, "freq", "lightsleep"):
+            raise ValueError("unknown power mode: %s" % (mode,))
+        self.mode = mode
+        self.idle_freq = idle_freq
+        self.min_sleep_ms = min_sleep_ms
+        self.max_sleep_ms = max_sleep_ms
+
+        self.asleep_ms = 0
+        self.awake_ms = 0
+        self._woke = utime.ticks_ms()
+
+    def sleep(self, ms, streams=()):
+        """Sleep for up to ms, or until one of the streams becomes readable. Returns the time slept."""
+        if not self.mode or ms < self.min_sleep_ms:
+            return 0
+        poller = uselect.poll()
+        for stream in streams:
+            poller.register(stream, uselect.POLLIN)
+        if poller.poll(0):
+            return 0
+
+        start = utime.ticks_ms()
+        self.awake_ms += utime.ticks_diff(start, self._woke)
+        if self.mode == "lightsleep":
+            machine.lightsleep(min(ms, self.max_sleep_ms))
+        else:
+            freq = machine.freq()
+            machine.freq(self.idle_freq)
+            try:
+                poller.poll(ms)
+            finally:
+                machine.freq(freq)
+        self._woke = utime.ticks_ms()
+        slept = utime.ticks_diff(self._woke, start)
+        self.asleep_ms += slept
+        return slept
+
+    def stats(self):
+        """Return (asleep_ms, awake_ms) since startup."""
+        return self.asleep_ms, self.awake_ms + utime.ticks_diff(utime.ticks_ms(), self._woke)
@@ -0,0 +1,188 @@
+# State kept on the flash filesystem across resets.
+#
+# Files are replaced atomically: the new content is written to a temporary file which is then renamed
+# over the old one, so a reset in the middle of a write leaves either the old or the new version.
+#
+# Flash wears out with every erase, so Journal collects changes in RAM and appends them in batches,
+# and rewrites its log only when it has grown beyond a size limit. Sequence writes only once for a
+# whole block of numbers.
+
+import ujson
+import uos
+import urandom
+import utime
+from aio import asyncio, sleep_ms
+
+
+def write_atomic(path, data):
+    """Replace the content of the file at path with data."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    uos.rename(tmp, path)
+
+
+def read_json(path, default=None):
+    """Load a JSON file, or return default if it is missing or damaged."""
+    try:
+        with open(path) as f:
+            return ujson.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, obj):
+    """Atomically store obj as JSON."""
+    write_atomic(path, ujson.dumps(obj).encode())
+
+
+class Sequence:
+    """Strictly increasing numbers that are never handed out twice, not even across resets.
+
+    Numbers are leased in blocks of block_size: the end of a block is stored before its first number
+    is handed out, so flash is written once per block. After a reset, numbering continues at the end
+    of the last lease and the rest of that block is skipped. It never starts below start.
+
+    Without a lease on flash, e.g. after the flash was erased, nothing is known about the numbers handed
+    out before. If start is None, a new sequence then begins at a random 30 bit number, which stays a
+    small int on MicroPython.
+    """
+
+    def __init__(self, path, block_size=32, start=0):
+        self.path = path
+        self.block_size = block_size
+        leased = read_json(path)
+        if isinstance(leased, int):
+            self._next = max(leased, start or 0)
+        elif start is None:
+            self._next = urandom.getrandbits(30)
+        else:
+            self._next = start
+        self._limit = self._next
+
+    def next(self):
+        """Return the next number."""
+        if self._next >= self._limit:
+            self._limit = self._next + self.block_size
+            write_json(self.path, self._limit)
+        value = self._next
+        self._next += 1
+        return value
+
+
+class Journal:
+    """Messages waiting to be delivered, kept in an append-only log on flash.
+
+    Every message has a kind (e.g. "matrix" or "mqtt") and a key (e.g. the room or topic) and a new
+    message supersedes the pending one of the same kind and key, so only the latest message per key is
+    delivered. Changes are appended to the log flush_delay ms after the first unwritten one. When the
+    log grows beyond max_size bytes, it is rewritten with only the pending messages.
+    """
+
+    def __init__(self, path, max_size=2048, flush_delay=2000):
+        self.path = path
+        self.max_size = max_size
+        self.flush_delay = flush_delay
+
+        # (kind, key) -> [sequence number, value]
+        self._pending = {}
+        self._seq = 0
+        self._lines = []
+        self._flush_at = None
+        self._dirty = asyncio.Event()
+        self._size = self._load()
+
+    def _load(self):
+        size = 0
+        torn = False
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    size += len(line)
+                    try:
+                        seq, kind, key, value = ujson.loads(line)
+                    except ValueError:
+                        # torn write of the last batch
+                        torn = True
+                        continue
+                    self._seq = max(self._seq, seq + 1)
+                    if value is None:
+                        self._pending.pop((kind, key), None)
+                    else:
+                        self._pending[(kind, key)] = [seq, value]
+        except OSError:
+            pass
+        if torn:
+            # later appends must not continue the damaged line
+            self.compact()
+            return self._size
+        return size
+
+    def pending(self, kind):
+        """Return [(key, value), ...] of the pending messages of a kind, oldest first."""
+        entries = [(seq, key, value) for (k, key), (seq, value) in self._pending.items() if k == kind]
+        entries.sort()
+        return [(key, value) for _, key, value in entries]
+
+    def get(self, kind, key):
+        """Return the pending message for a key, or None."""
+        entry = self._pending.get((kind, key))
+        return entry[1] if entry else None
+
+    def set(self, kind, key, value):
+        """Record a message waiting for delivery, superseding the pending one for the same key."""
+        self._pending[(kind, key)] = [self._seq, value]
+        self._append([self._seq, kind, key, value])
+        self._seq += 1
+
+    def clear(self, kind, key):
+        """Record that the pending message for a key was delivered or given up."""
+        if self._pending.pop((kind, key), None) is not None:
+            self._append([self._seq, kind, key, None])
+            self._seq += 1
+
+    def _append(self, record):
+        self._lines.append(ujson.dumps(record) + "\n")
+        if self._flush_at is None:
+            self._flush_at = utime.ticks_add(utime.ticks_ms(), self.flush_delay)
+            self._dirty.set()
+
+    def due_in(self):
+        """Number of ms until unwritten changes are flushed, or None if there are none."""
+        if self._flush_at is None:
+            return None
+        return max(0, utime.ticks_diff(self._flush_at, utime.ticks_ms()))
+
+    def flush(self):
+        """Write all changes to flash now."""
+        if not self._lines:
+            return
+        data = "".join(self._lines)
+        self._lines = []
+        self._flush_at = None
+        if self._size + len(data) > self.max_size:
+            self.compact()
+            return
+        with open(self.path, "a") as f:
+            f.write(data)
+        self._size += len(data)
+
+    def compact(self):
+        """Rewrite the log with only the pending messages."""
+        entries = [(seq, kind, key, value) for (kind, key), (seq, value) in self._pending.items()]
+        entries.sort()
+        data = "".join([ujson.dumps(list(entry)) + "\n" for entry in entries])
+        self._lines = []
+        self._flush_at = None
+        write_atomic(self.path, data.encode())
+        self._size = len(data)
+
+    async def run(self):
+        """Flush changes in batches forever."""
+        while True:
+            if self._flush_at is None:
+                self._dirty.clear()
+                await self._dirty.wait()
+                continue
+            await sleep_ms(self.due_in())
+            self.flush()
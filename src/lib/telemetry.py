@@ -0,0 +1,153 @@
+# Counters and timers of the hot paths, for a look at a display in the field.
+#
+# Everything is recorded into arrays allocated once at startup, so recording costs a few
+# microseconds and allocates nothing. The wrappers of the MQTT hot paths have fixed signatures, as
+# *args and **kwargs would allocate a tuple and a dict per call on MicroPython. report() turns the
+# arrays into a compact JSON payload now and then and starts the next period.
+
+import gc
+import ujson
+import utime
+from uarray import array
+from aio import sleep_ms
+
+# timers, see Telemetry.add()
+CHECK_MSG = 0
+PUBLISH = 1
+MATRIX_REQUEST = 2
+_TIMER_NAMES = ("check_msg", "publish", "matrix")
+
+# upper bounds of the loop histogram bins in ms, the last bin counts everything above
+LOOP_BINS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _largest_free_block():
+    # The GC heap has no such figure, the ESP-IDF heap that sockets and TLS allocate from does.
+    try:
+        import esp32
+
+        return max([heap[2] for heap in esp32.idf_heap_info(esp32.HEAP_DATA)])
+    except (ImportError, AttributeError, ValueError):
+        return None
+
+
+class Telemetry:
+    """Timers, a loop histogram, the watchdog margin and gauges, reported per period.
+
+    The loop histogram counts how late the probe() task wakes up after sleeping probe_interval ms,
+    which is how long other tasks kept the event loop busy.
+    """
+
+    def __init__(self, probe_interval=100):
+        self.probe_interval = probe_interval
+        # count, total us and max us of every timer
+        self._timers = array("I", [0] * 3 * len(_TIMER_NAMES))
+        self._loop = array("I", [0] * (len(LOOP_BINS) + 1))
+        self._watchdog_margin = None
+        # (name, function returning the current value)
+        self._gauges = []
+        self._probe_at = utime.ticks_ms()
+        self._started = utime.time()
+
+    def add(self, timer, start):
+        """Record a duration of a timer, from start in utime.ticks_us() until now."""
+        duration = utime.ticks_diff(utime.ticks_us(), start)
+        i = timer * 3
+        timers = self._timers
+        timers[i] += 1
+        timers[i + 1] += duration
+        if duration > timers[i + 2]:
+            timers[i + 2] = duration
+
+    def timed(self, timer, f):
+        """Return f, which takes no arguments like check_msg(), wrapped to record every call in a timer."""
+        add = self.add
+
+        def wrapper():
+            start = utime.ticks_us()
+            try:
+                return f()
+            finally:
+                add(timer, start)
+
+        return wrapper
+
+    def timed_publish(self, timer, f):
+        """Return the publish() method f of an MQTT client wrapped to record every call in a timer."""
+        add = self.add
+
+        def wrapper(topic, msg, retain=False, qos=0):
+            start = utime.ticks_us()
+            try:
+                return f(topic, msg, retain, qos)
+            finally:
+                add(timer, start)
+
+        return wrapper
+
+    def timed_async(self, timer, f):
+        """Return the coroutine function f wrapped to record every call in a timer.
+
+        Calling a coroutine function allocates anyway, so this wrapper takes any arguments.
+        """
+        add = self.add
+
+        async def wrapper(*args, **kwargs):
+            start = utime.ticks_us()
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                add(timer, start)
+
+        return wrapper
+
+    def watchdog(self, margin):
+        """Record how many ms were left before the watchdog would have reset the board."""
+        if self._watchdog_margin is None or margin < self._watchdog_margin:
+            self._watchdog_margin = margin
+
+    def gauge(self, name, f):
+        """Report f() as name, read when the report is made."""
+        self._gauges.append((name, f))
+
+    def _loop_iteration(self, ms):
+        bins = self._loop
+        for i in range(len(LOOP_BINS)):
+            if ms <= LOOP_BINS[i]:
+                bins[i] += 1
+                return
+        bins[len(LOOP_BINS)] += 1
+
+    def due_in(self):
+        """Number of ms until the probe wakes up."""
+        return max(0, utime.ticks_diff(self._probe_at, utime.ticks_ms()))
+
+    async def probe(self):
+        """Measure the event loop forever."""
+        while True:
+            self._probe_at = utime.ticks_add(utime.ticks_ms(), self.probe_interval)
+            await sleep_ms(self.probe_interval)
+            self._loop_iteration(max(0, utime.ticks_diff(utime.ticks_ms(), self._probe_at)))
+
+    def report(self):
+        """Return the payload of the period that ended now and start the next one.
+
+        Timers are reported as [count, total us, max us], the loop histogram as the counts of the
+        LOOP_BINS and the watchdog margin as the smallest one in ms.
+        """
+        report = {"up": utime.time() - self._started}
+        for i in range(len(_TIMER_NAMES)):
+            report[_TIMER_NAMES[i]] = list(self._timers[i * 3 : i * 3 + 3])
+        report["loop"] = list(self._loop)
+        report["wdt"] = self._watchdog_margin
+        report["free"] = gc.mem_free()
+        report["block"] = _largest_free_block()
+        for name, f in self._gauges:
+            report[name] = f()
+
+        for i in range(len(self._timers)):
+            self._timers[i] = 0
+        for i in range(len(self._loop)):
+            self._loop[i] = 0
+        self._watchdog_margin = None
+        return ujson.dumps(report).encode()
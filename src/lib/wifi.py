@@ -1,11 +1,39 @@
 import network
 import time
+from ubinascii import hexlify, unhexlify
+from aio import asyncio
+from storage import read_json, write_json
+from deadline import Deadline
+
+# The link is supervised by a state machine that poll() advances without ever blocking:
+#   CONNECTING  waiting for an association started by _associate(), until CONNECT_TIMEOUT
+#   CONNECTED   link is up, poll() notices when it drops and reconnects right away
+#   BACKOFF     an attempt failed, the next one starts after a growing delay
+# The BSSID and channel of the last good access point are cached on flash, so a reconnect can go
+# straight to it instead of scanning all channels first. Without one, an attempt scans first, so the
+# access point it connects to is cached again.
+IDLE = 0
+CONNECTING = 1
+CONNECTED = 2
+BACKOFF = 3
+
+# not every port knows every failure status
+_FAILED = tuple(getattr(network, name) for name in (
+	'STAT_WRONG_PASSWORD', 'STAT_NO_AP_FOUND', 'STAT_CONNECT_FAIL', 'STAT_ASSOC_FAIL',
+	'STAT_HANDSHAKE_TIMEOUT', 'STAT_BEACON_TIMEOUT') if hasattr(network, name))
 
 class Wifi(object):
 	nic = None
 	essid = None
 	password= None
 
+	CACHE_FILE = 'wifi.json'
+	CONNECT_TIMEOUT = 15000
+	# how long a scan of all channels takes at most, in ms
+	SCAN_TIME = 5000
+	BACKOFF_MIN = 1000
+	BACKOFF_MAX = 60000
+
 	def __init__(self, ssid, password, ifconfig=None):
 		self.nic = network.WLAN(network.STA_IF)
 		self.nic.active(True)
@@ -13,19 +41,145 @@ class Wifi(object):
 		self.password = password
 		if ifconfig:
 			self.nic.ifconfig(tuple(ifconfig))
+		self.state = IDLE
+		self.failures = 0
+		# links established so far, every one after the first is a reconnect
+		self.connects = 0
+		self._deadline = 0
+		self._poll_at = time.ticks_ms()
+		self._target = None
+		self._up = asyncio.Event()
+		self._cache = read_json(self.CACHE_FILE, {})
+		if self._cache.get('ssid') != self.essid:
+			self._cache = {}
 
-	def connect(self):
+	def _scan(self):
+		# Strongest access point of our network as (bssid, channel), or None. Blocks for a few seconds.
+		best = None
+		for ssid, bssid, channel, rssi, authmode, hidden in self.nic.scan():
+			if ssid.decode() == self.essid and (best is None or rssi > best[2]):
+				best = (bssid, channel, rssi)
+		return best and best[:2]
+
+	def _associate(self, target):
+		self._target = target
 		if self.nic.isconnected():
-			print('already connected to wifi, disconnecting')
 			self.nic.disconnect()
-		self.nic.connect(self.essid, self.password)
-		retries = 0
-		while not self.nic.isconnected() and not self.nic.status() == network.STAT_GOT_IP:
-			time.sleep_ms(500)
-			retries += 1
-
-			if retries > 120*5:
-				print('could not connect to wifi')
-				return False
+		if target:
+			bssid, channel = target
+			try:
+				self.nic.config(channel=channel)
+			except (ValueError, TypeError, OSError):
+				pass
+			print('connecting to wifi access point', hexlify(bssid, ':').decode(), 'on channel', channel)
+			self.nic.connect(self.essid, self.password, bssid=bssid)
+		else:
+			self.nic.connect(self.essid, self.password)
+		self.state = CONNECTING
+		self._deadline = time.ticks_add(time.ticks_ms(), self.CONNECT_TIMEOUT)
+
+	def _cached_target(self):
+		if self._cache.get('bssid'):
+			return unhexlify(self._cache['bssid']), self._cache['channel']
+		return None
+
+	def start(self, scan=True):
+		"""Start connecting without waiting for the link, see poll().
+
+		Without a cached access point and with scan set, the network is scanned first, which blocks for
+		a few seconds. Otherwise the driver finds the access point itself.
+		"""
+		target = self._cached_target()
+		# an error of the driver is a failed attempt like any other, it must not end the supervisor
+		try:
+			if target is None and scan:
+				target = self._scan()
+			self._associate(target)
+		except OSError as e:
+			self._failed(e)
+
+	def poll(self):
+		"""Advance the link state machine. Returns the number of ms until it should be polled again."""
+		wait = self._advance(time.ticks_ms())
+		self._poll_at = time.ticks_add(time.ticks_ms(), wait)
+		return wait
+
+	def due_in(self):
+		"""Number of ms until poll() is due."""
+		return max(0, time.ticks_diff(self._poll_at, time.ticks_ms()))
+
+	def _advance(self, now):
+		if self.state == CONNECTED:
+			if self.nic.isconnected():
+				return 1000
+			print('wifi link lost, reconnecting')
+			self._up.clear()
+			self.start()
+			return 100
+		if self.state == CONNECTING:
+			if self.nic.isconnected():
+				self._connected()
+				return 1000
+			status = self.nic.status()
+			if status not in _FAILED and time.ticks_diff(self._deadline, now) > 0:
+				return 100
+			self._failed(status)
+		if self.state == BACKOFF:
+			left = time.ticks_diff(self._deadline, now)
+			if left > 0:
+				return left
+			self.start()
+			return 100
+		return 1000
+
+	def _connected(self):
 		print('connected. network config:', self.nic.ifconfig())
-		return True
+		self.state = CONNECTED
+		self.failures = 0
+		self.connects += 1
+		if self._target:
+			bssid, channel = self._target
+			cache = {'ssid': self.essid, 'bssid': hexlify(bssid).decode(), 'channel': channel}
+			if cache != self._cache:
+				self._cache = cache
+				write_json(self.CACHE_FILE, cache)
+		self._up.set()
+
+	def _failed(self, status):
+		try:
+			self.nic.disconnect()
+		except OSError:
+			pass
+		if self._target and self._target == self._cached_target():
+			# the access point moved or is gone, let the driver look for the network
+			print('cached wifi access point not reachable')
+			self._cache = {}
+			write_json(self.CACHE_FILE, {})
+		self.failures += 1
+		delay = min(self.BACKOFF_MIN << min(self.failures - 1, 16), self.BACKOFF_MAX)
+		print('could not connect to wifi, status', status, 'retrying in', delay, 'ms')
+		self.state = BACKOFF
+		self._deadline = time.ticks_add(time.ticks_ms(), delay)
+
+	def isconnected(self):
+		return self.state == CONNECTED
+
+	async def wait_connected(self):
+		"""Wait until the link is up."""
+		await self._up.wait()
+
+	def connect(self, timeout=30000, deadline=None):
+		"""Connect, blocking until the link is up or timeout ms have passed. Returns whether it is up.
+
+		With a deadline.Deadline it gives up by that instead. The scan of start() is skipped if it could
+		not finish in time.
+		"""
+		deadline = deadline or Deadline(timeout)
+		self.start(scan=deadline.remaining() > self.SCAN_TIME)
+		while deadline.remaining():
+			wait = self.poll()
+			if self.state == CONNECTED:
+				return True
+			time.sleep_ms(min(wait, 100, deadline.remaining()))
+		print('could not connect to wifi')
+		return False
@@ -2,6 +2,8 @@ import machine
 import time
 import sys
 import json
+from collections import namedtuple
+from aio import asyncio, sleep_ms
 
 # this should be an enum but micropython doesn't support them
 # so we look like an enum but are in reality just class attributes.
@@ -11,49 +13,317 @@ class RoomStatus():
     INTERNAL_OPEN = 2
     CLOSED = 3
 
+# merged config of one room status, see StatusTable
+StatusConfig = namedtuple('StatusConfig', ('mqtt_name', 'human_name', 'led_pin', 'button_pin', 'matrix_rooms', 'announcement'))
+
+class StatusTable():
+    """The 'roomstatus' config section, compiled once into an immutable table.
+
+    Every status gets a StatusConfig with the '_default' section already merged in, its mqtt_name as
+    bytes and its Matrix announcement prebuilt, so looking up a status allocates nothing.
+    """
+    SECTIONS = (
+        (RoomStatus.PUBLIC_OPEN, 'public_open'),
+        (RoomStatus.INTERNAL_OPEN, 'internal_open'),
+        (RoomStatus.CLOSED, 'closed'),
+    )
+
+    def __init__(self, roomstatus):
+        self.configs = {}
+        self.by_mqtt_name = {}
+        for status, section in self.SECTIONS:
+            merged = roomstatus['_default'].copy()
+            merged.update(roomstatus[section])
+            mqtt_name = merged.get('mqtt_name')
+            if mqtt_name:
+                mqtt_name = mqtt_name.encode()
+                self.by_mqtt_name[mqtt_name] = status
+            self.configs[status] = StatusConfig(
+                mqtt_name,
+                merged.get('human_name'),
+                merged.get('led_pin'),
+                merged.get('button_pin'),
+                tuple(merged.get('matrix_rooms') or ()),
+                "Room Status is now " + merged.get('human_name'),
+            )
+        # an unknown status is published as closed, without the defaults merged in
+        self.unknown_mqtt_name = roomstatus['closed'].get('mqtt_name')
+        if self.unknown_mqtt_name:
+            self.unknown_mqtt_name = self.unknown_mqtt_name.encode()
+        self.unknown_announcement = "Room Status is now Unknown"
+
+def merge_config(config, delta):
+    """Return a copy of config with delta merged in, nested sections are merged key by key."""
+    merged = config.copy()
+    for key, value in delta.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge_config(merged[key], value)
+        merged[key] = value
+    return merged
+
 class Application():
+    WATCHDOG_TIMEOUT = 10000
+    WATCHDOG_FEED_INTERVAL = 2000
+    # how long a status restored at boot waits for the broker to confirm it, counted while connected
+    STALE_TIMEOUT = 10000
+    STALE_BLINK_INTERVAL = 500
+    MATRIX_RETRY_DELAY = 2000
+    MATRIX_RETRY_MAX_DELAY = 60000
+    # the last config delta received over mqtt, applied on top of the config files
+    CONFIG_OVERRIDE_FILE = 'config_override.json'
+    # sections a config delta may change, with the keys that can be applied without a reset (None for all)
+    LIVE_CONFIG = {'roomstatus': None, 'matrix': ('displayname', 'rooms')}
+
     def __init__(self):
         self.__running = True
         self.__room_status = RoomStatus.UNKNOWN
         self.__room_status_updated = 0
+        self.__stale = False
+        self.__snapshot_status = None
 
         print('loading config')
         self.config = {}
         self.config.update(json.load(open("config_base.json")))
         self.config.update(json.load(open("config_device.json")))
+        self.load_config_override()
 
         print('starting setup')
+        self.setup_power(self.config.get('power'))
         self.setup_led_buttons()
+        self.restore_status()
+        self.setup_journal()
         self.setup_wifi(self.config['wifi'])
         self.setup_mqtt(self.config['mqtt'])
         self.setup_matrix(self.config['matrix'])
-        self.watchdog = machine.WDT(timeout=10000)
+        self.setup_telemetry(self.config['mqtt'])
+        self.watchdog = machine.WDT(timeout=self.WATCHDOG_TIMEOUT)
         self.watchdog.feed()
+        self.__watchdog_fed = time.ticks_ms()
         print('setup done')
 
-        self.set_room_status(RoomStatus.UNKNOWN, publish=False)
+    def load_config_override(self):
+        from storage import read_json
+
+        self.__file_config = self.config
+        self.__config_version = 0
+        self.__config_hash = None
+        override = read_json(self.CONFIG_OVERRIDE_FILE)
+        if override:
+            try:
+                config, status_table = self.validate_config(override['config'])
+                self.config = config
+                self.status_table = status_table
+                self.__config_version = override['version']
+                self.__config_hash = override['hash']
+                print("using config version", self.__config_version)
+                return
+            except (KeyError, TypeError, ValueError) as e:
+                print("ignoring config override:", e)
+        self.status_table = StatusTable(self.config['roomstatus'])
+
+    def validate_config(self, delta):
+        """Merge a config delta into the config files and check the result.
+
+        Returns the new config and its StatusTable, or raises ValueError if the delta changes something
+        that cannot be applied without a reset or the result is not usable.
+        """
+        if not isinstance(delta, dict):
+            raise ValueError("config delta is not an object")
+        for section, values in delta.items():
+            if section not in self.LIVE_CONFIG or not isinstance(values, dict):
+                raise ValueError("config section cannot be changed: " + str(section))
+            keys = self.LIVE_CONFIG[section]
+            for key in values:
+                if keys is not None and key not in keys:
+                    raise ValueError("config key cannot be changed: " + section + "." + str(key))
+        if 'matrix' in delta and not self.__file_config.get('matrix'):
+            raise ValueError("matrix is not configured")
+        config = merge_config(self.__file_config, delta)
+        self.validate_roomstatus(config['roomstatus'])
+        try:
+            status_table = StatusTable(config['roomstatus'])
+        except Exception as e:
+            # the config arrives over mqtt, nothing in it may reset the board
+            raise ValueError("roomstatus cannot be compiled: " + repr(e))
+        # whether the board has a pin only shows when it is set up, see reload_config
+        pins = []
+        for status_config in status_table.configs.values():
+            for pin in (status_config.led_pin, status_config.button_pin):
+                if pin is None:
+                    continue
+                if not isinstance(pin, int):
+                    raise ValueError("pin is not a number: " + str(pin))
+                if pin in pins:
+                    raise ValueError("pin is used twice: " + str(pin))
+                pins.append(pin)
+        if config['matrix'] and not isinstance(config['matrix'].get('rooms') or [], list):
+            raise ValueError("matrix rooms is not a list")
+        return config, status_table
+
+    def validate_roomstatus(self, roomstatus):
+        # the types StatusTable relies on, raises ValueError
+        if not isinstance(roomstatus, dict):
+            raise ValueError("roomstatus is not an object")
+        for section in ('_default',) + tuple(name for _, name in StatusTable.SECTIONS):
+            values = roomstatus.get(section)
+            if not isinstance(values, dict):
+                raise ValueError("roomstatus." + section + " is not an object")
+            for key in ('mqtt_name', 'human_name'):
+                value = values.get(key)
+                if value is not None and not isinstance(value, str):
+                    raise ValueError("roomstatus." + section + "." + key + " is not a string")
+            rooms = values.get('matrix_rooms')
+            if rooms is not None and not (isinstance(rooms, list) and all(isinstance(room, str) for room in rooms)):
+                raise ValueError("roomstatus." + section + ".matrix_rooms is not a list of room ids")
+
+    def reload_config(self, payload):
+        """Apply a config delta received over mqtt as {"version": <int>, "config": {<sections>}}.
+
+        The delta is merged into the config files, not into the previous delta, so every message carries
+        all changes. It is applied to the status table, the LEDs and buttons and the Matrix rooms right
+        away, and stored on flash only once that worked. If it fails, the previous config is set up again.
+        A delta that is not newer than the applied one is ignored, so retained and repeated deliveries
+        change nothing.
+        """
+        from storage import write_json
+        from uhashlib import sha256
+        from ubinascii import hexlify
+
+        digest = hexlify(sha256(payload).digest()).decode()
+        if digest == self.__config_hash:
+            return
+        try:
+            update = json.loads(payload)
+            version = update['version']
+            if not isinstance(version, int):
+                raise ValueError("config version is not a number")
+            if version <= self.__config_version:
+                print("ignoring config version", version, "as version", self.__config_version, "is applied")
+                return
+            config, status_table = self.validate_config(update['config'])
+        except (KeyError, TypeError, ValueError) as e:
+            print("rejecting config update:", e)
+            return
+        print("applying config version", version)
+        previous = self.config, self.status_table
+        self.config = config
+        self.status_table = status_table
+        try:
+            self.apply_config()
+        except Exception as e:
+            # e.g. a pin the board does not have. Stored, the delta would fail again at every boot.
+            print("config version", version, "cannot be applied:", repr(e))
+            self.config, self.status_table = previous
+            self.apply_config()
+            return
+        write_json(self.CONFIG_OVERRIDE_FILE, {'version': version, 'hash': digest, 'config': update['config']})
+        self.__config_version = version
+        self.__config_hash = digest
+
+    def apply_config(self):
+        for led in self.leds.values():
+            if led:
+                led.off()
+        self.buttons.clear()
+        self.setup_pins()
+        self.update_leds()
+        if self.matrix and self.matrix_started:
+            asyncio.create_task(self.update_matrix_profile())
+
+    def setup_power(self, config):
+        from power import Power
+
+        config = config or {}
+        self.power = Power(
+                mode=config.get('mode'),
+                idle_freq=config.get('idle_freq', 80000000),
+                max_sleep_ms=config.get('max_sleep_ms', 1000))
 
     def setup_led_buttons(self):
+        from buttons import Buttons
+
+        self.buttons = Buttons()
+        try:
+            self.setup_pins()
+        except Exception as e:
+            if not self.__config_version:
+                raise
+            # the stored config delta was applied before, but the config files are what the board was
+            # flashed with
+            print("config version", self.__config_version, "cannot be applied, using the config files:", repr(e))
+            self.config = self.__file_config
+            self.status_table = StatusTable(self.config['roomstatus'])
+            self.__config_version = 0
+            self.__config_hash = None
+            self.buttons.clear()
+            self.setup_pins()
+
+    def setup_pins(self):
         self.leds = {}
-        self.buttons = {}
         for status_option in (RoomStatus.PUBLIC_OPEN, RoomStatus.INTERNAL_OPEN, RoomStatus.CLOSED):
             status_config = self.config_for_status(status_option)
             self.leds[status_option] = None
-            self.buttons[status_option] = None
-            if status_config.get('led_pin'):
-                self.leds[status_option] = machine.Pin(status_config['led_pin'], machine.Pin.OUT)
+            if status_config.led_pin:
+                self.leds[status_option] = machine.Pin(status_config.led_pin, machine.Pin.OUT)
                 self.leds[status_option].off()
-            if status_config.get('button_pin'):
-                self.buttons[status_option] = machine.Pin(status_config['button_pin'], machine.Pin.IN, machine.Pin.PULL_UP)
+            if status_config.button_pin:
+                pin = machine.Pin(status_config.button_pin, machine.Pin.IN, machine.Pin.PULL_UP)
+                self.buttons.add(status_option, pin, wake=machine.SLEEP if self.power.mode == 'lightsleep' else None)
+
+    def load_snapshot(self):
+        from storage import read_json
+
+        # RTC memory survives resets but not power loss, the flash copy survives both
+        snapshots = [read_json('status.json')]
+        try:
+            snapshots.append(json.loads(machine.RTC().memory()))
+        except (ValueError, AttributeError):
+            pass
+        snapshots = [snapshot for snapshot in snapshots if isinstance(snapshot, list) and len(snapshot) == 2]
+        if not snapshots:
+            return None
+        return max(snapshots, key=lambda snapshot: snapshot[1])
+
+    def save_snapshot(self, status):
+        from storage import write_json
+
+        if status == self.__snapshot_status:
+            return
+        self.__snapshot_status = status
+        snapshot = [status, time.time()]
+        try:
+            machine.RTC().memory(json.dumps(snapshot))
+        except AttributeError:
+            pass
+        write_json('status.json', snapshot)
+
+    def restore_status(self):
+        snapshot = self.load_snapshot()
+        if not snapshot or not self.config_for_status(snapshot[0]):
+            return
+        status, saved = snapshot
+        print("restoring status", self.translate_status_to_human(status), "saved", time.time() - saved, "s ago")
+        self.__room_status = status
+        self.__snapshot_status = status
+        # without a broker to confirm it, the status is as good as it gets
+        self.__stale = bool(self.config['mqtt'] and self.config['mqtt'].get('statustopic'))
+        self.update_leds()
+
+    def setup_journal(self):
+        from storage import Journal
+
+        # status messages not delivered yet, kept across resets
+        self.journal = Journal('journal.log')
 
     def setup_wifi(self, config):
         from wifi import Wifi
 
+        # the link comes up while the loop is running, see wifi_task
         self.wifi = Wifi(config['ssid'], config['password'], config['ifconfig'])
-        if not self.wifi.connect():
-            machine.reset()
-        # this sleep is needed to fix some init race condition
-        time.sleep_ms(300)
+        self.wifi.start()
+        # addresses of broker and homeserver, looked up again in the background once stale
+        from dnscache import resolver
+        self.resolver = resolver
 
     def setup_mqtt(self, config):
         if not config:
@@ -61,102 +331,330 @@ class Application():
             self.mqtt = None
             return
 
-        from mqtt import MQTTClient
+        from mqtt import MQTTClient, Router
 
-        def mqtt_callback(topic, message):
-            topic = topic.decode()
-            message = message.decode()
-            if topic == config.get('statustopic'):
-                parsed_status = self.translate_status_from_mqtt(message)
-                print("status topic detected", parsed_status)
-                self.set_room_status(parsed_status, publish=False, force_update=True)
-            else:
-                print("unknown mqtt message:", topic, message)
+        self.statustopic = config.get('statustopic')
+        if self.statustopic:
+            self.statustopic = self.statustopic.encode()
+        self.__status_pid = 0
+
+        # topic and message are memoryviews into the receive buffer
+        def status_handler(topic, message):
+            parsed_status = self.translate_status_from_mqtt(bytes(message))
+            print("status topic detected", parsed_status)
+            self.reconcile_status(parsed_status)
+
+        def config_handler(topic, message):
+            self.reload_config(bytes(message))
+
+        def unknown_handler(topic, message):
+            print("unknown mqtt message:", bytes(topic), bytes(message))
+
+        self.mqtt_router = Router(default=unknown_handler)
+        if self.statustopic:
+            self.mqtt_router.add(self.statustopic, status_handler)
+        if config.get('configtopic'):
+            self.mqtt_router.add(config['configtopic'].encode(), config_handler)
 
         self.mqtt = MQTTClient(config['devicename'], server=config['broker'], port=config['brokerport'])
         self.mqtt.DEBUG = True
-        self.mqtt.set_callback(mqtt_callback)
-        time.sleep_ms(300)
-        print("connecting to mqtt server at", config['broker'], config['brokerport'])
-        while True:
-            if not self.mqtt.connect():
-                print('new mqtt session being set up')
-                break
+        # the status is kept in the journal until the broker acknowledged it
+        def mqtt_ack_callback(pid):
+            if pid == self.__status_pid:
+                self.__status_pid = 0
+                self.journal.clear('mqtt', self.statustopic.decode())
+
+        self.mqtt.set_callback(self.mqtt_router.dispatch)
+        self.mqtt.set_ack_callback(mqtt_ack_callback)
+        # messages are queued until the connection is up, see mqtt_task
+        for topic, message in self.journal.pending('mqtt'):
+            if topic.encode() != self.statustopic:
+                self.journal.clear('mqtt', topic)
+                continue
+            print("publishing status from before the reset:", message)
+            self.set_room_status(self.translate_status_from_mqtt(message.encode()), publish=False, force_update=True)
+            self.__status_pid = self.mqtt.publish(self.statustopic, message.encode(), retain=True, qos=1)
+        print("suscribing to mqtt topics:", [topic for topic, qos in self.mqtt_router.filters])
+        self.mqtt_router.subscribe(self.mqtt)
+
+    def reconcile_status(self, remote_status):
+        """Apply a status received from the broker, resolving a stale status restored at boot.
+
+        A stale status is confirmed by the same status from the broker. If it differs, the local status
+        wins only while its own publication is still waiting in the journal, as the broker then has not
+        seen it yet. Otherwise somebody else changed the status while we were down and the broker wins.
+        """
+        if self.__stale:
+            self.__stale = False
+            if remote_status == self.__room_status:
+                print("restored status confirmed by the broker")
+            elif self.journal.get('mqtt', self.statustopic.decode()) is not None:
+                print("broker has an older status, keeping ours")
+                self.update_leds()
+                return
             else:
-                print('mqtt connection failed, retrying')
-                time.sleep(3)
-        statustopic = config.get('statustopic')
-        if statustopic:
-            print("suscribing to mqtt status topic: ", statustopic)
-            self.mqtt.subscribe(statustopic)
+                print("restored status is outdated")
+        self.set_room_status(remote_status, publish=False, force_update=True)
 
     def config_for_status(self, input_status):
-        status_config = self.config['roomstatus']['_default'].copy()
-        if input_status == RoomStatus.PUBLIC_OPEN:
-            status_config.update(self.config['roomstatus']['public_open'])
-        elif input_status == RoomStatus.INTERNAL_OPEN:
-            status_config.update(self.config['roomstatus']['internal_open'])
-        elif input_status == RoomStatus.CLOSED:
-            status_config.update(self.config['roomstatus']['closed'])
-        else:
-            return None
-        return status_config
+        return self.status_table.configs.get(input_status)
 
     def translate_status_to_mqtt(self, input_status):
         status_config = self.config_for_status(input_status)
         if status_config:
-            return status_config.get('mqtt_name')
+            return status_config.mqtt_name
         else:
-            return self.config['roomstatus']['closed'].get('mqtt_name')
+            return self.status_table.unknown_mqtt_name
 
     def translate_status_to_human(self, input_status):
         status_config = self.config_for_status(input_status)
         if status_config:
-            return status_config.get('human_name')
+            return status_config.human_name
         else:
             return "Unknown"
 
     def translate_status_from_mqtt(self, input_status):
-        for status_option in (RoomStatus.PUBLIC_OPEN, RoomStatus.INTERNAL_OPEN, RoomStatus.CLOSED):
-            status_config = self.config_for_status(status_option)
-            if status_config and status_config.get('mqtt_name') == input_status:
-                return status_option
-        return RoomStatus.UNKNOWN
+        return self.status_table.by_mqtt_name.get(input_status, RoomStatus.UNKNOWN)
 
     def setup_matrix(self, config):
         if not config:
             print("no matrix config found, skipping matrix setup")
             self.matrix = None
+            self.outbox = None
             return
 
-        from mytrix import Matrix
+        from mytrix import AsyncMatrix, Outbox
+        from storage import Sequence
 
-        self.matrix = Matrix(
+        self.load_session(config)
+        # an id taken once is never used again, even if it was taken before a reset. Older versions kept
+        # the next id in the session, numbering continues from there. On erased flash it starts at random,
+        # as the access token may have been used before and the homeserver drops a message with an id it
+        # has seen under that token.
+        txn_ids = Sequence('txn_id.json', start=self.session.pop('txn_id', None))
+        self.matrix = AsyncMatrix(
                 homeserver=config['homeserver'],
                 matrix_id=config['matrix_id'],
-                access_token=config['access_token'],
+                access_token=config['access_token'] or self.session.get('access_token'),
                 username=config['username'],
-                password=config['password'])
-        if config.get('displayname'):
-            self.matrix.set_displayname(config['displayname'])
-        if config.get('rooms'):
-            for room in config.get('rooms'):
-                self.matrix.join_room(room)
-
-    def loop(self):
-        print('loop started')
+                password=config['password'],
+                txn_ids=txn_ids)
+        self.outbox = Outbox(self.matrix, journal=self.journal, rejoin=self.rejoin_matrix_room)
+        self.matrix_started = False
+        # ticks of the next login attempt, None while waiting for the link or once logged in
+        self.__matrix_login_at = None
+
+    def setup_telemetry(self, config):
+        if not (config and config.get('telemetrytopic')):
+            self.telemetry = None
+            return
+
+        import telemetry
+
+        self.telemetry_topic = config['telemetrytopic'].encode()
+        self.telemetry_interval = config.get('telemetry_interval', 60) * 1000
+        self.__telemetry_at = time.ticks_ms()
+        self.telemetry = telemetry.Telemetry(probe_interval=config.get('telemetry_probe_ms', 100))
+        # the hot paths are timed by wrapping them, so the clients know nothing about telemetry
+        self.mqtt.check_msg = self.telemetry.timed(telemetry.CHECK_MSG, self.mqtt.check_msg)
+        self.mqtt.publish = self.telemetry.timed_publish(telemetry.PUBLISH, self.mqtt.publish)
+        if self.matrix:
+            self.matrix._request = self.telemetry.timed_async(telemetry.MATRIX_REQUEST, self.matrix._request)
+        self.telemetry.gauge('mqtt', lambda: self.mqtt.connects)
+        self.telemetry.gauge('wifi', lambda: self.wifi.connects)
+        if self.power.mode:
+            # [asleep ms, awake ms] since startup
+            self.telemetry.gauge('power', self.power.stats)
+
+    def load_session(self, config):
+        from storage import read_json
+
+        # what a previous boot already did on the homeserver, so it is not done again
+        self.session = read_json('session.json', {})
+        if self.session.get('homeserver') != config['homeserver'] or self.session.get('matrix_id') != config['matrix_id']:
+            self.session = {'homeserver': config['homeserver'], 'matrix_id': config['matrix_id'], 'rooms': []}
+
+    def save_session(self):
+        from storage import write_json
+
+        write_json('session.json', self.session)
+
+    async def start_matrix(self):
+        self.__matrix_login_at = None
+        await self.wifi.wait_connected()
+        self.__matrix_login_at = time.ticks_ms()
+        await self.matrix.ensure_login()
+        self.__matrix_login_at = None
+        if not self.config['matrix']['access_token'] and self.matrix.access_token != self.session.get('access_token'):
+            self.session['access_token'] = self.matrix.access_token
+            self.save_session()
+
+    async def update_matrix_profile(self):
+        # The config may change while this runs, see reload_config. What fails is tried again at the next
+        # boot or config change, and a room that was not joined is joined once a message to it is refused,
+        # see rejoin_matrix_room.
+        config = self.config['matrix']
+        changed = False
+        displayname = config.get('displayname')
+        if displayname and displayname != self.session.get('displayname'):
+            try:
+                await self.matrix.set_displayname(displayname)
+                self.session['displayname'] = displayname
+                changed = True
+            except Exception as e:
+                print("matrix displayname not set:", e)
+        for room in config.get('rooms') or ():
+            if room in self.session['rooms']:
+                continue
+            try:
+                await self.matrix.join_room(room)
+            except Exception as e:
+                print("matrix room", room, "not joined:", e)
+                continue
+            if room not in self.session['rooms']:
+                self.session['rooms'].append(room)
+                changed = True
+        if changed:
+            self.save_session()
+
+    async def rejoin_matrix_room(self, room):
+        # the homeserver refused a message, so we were kicked or left: forget that we joined the room,
+        # so it is joined again on the next boot if joining it now fails
+        if room in self.session['rooms']:
+            self.session['rooms'].remove(room)
+            self.save_session()
+        await self.matrix.join_room(room)
+        if room not in self.session['rooms']:
+            self.session['rooms'].append(room)
+            self.save_session()
+
+    async def run(self):
+        print('runtime started')
+        tasks = [self.watchdog_task(), self.wifi_task(), self.resolver.run(), self.button_task(), self.journal.run()]
+        if self.mqtt:
+            tasks.append(self.mqtt_task())
+        if self.matrix:
+            tasks.append(self.matrix_task())
+        if self.__stale:
+            tasks.append(self.stale_task())
+        if self.telemetry:
+            tasks.append(self.telemetry.probe())
+            tasks.append(self.telemetry_task())
+        if self.power.mode:
+            tasks.append(self.idle_task())
+        await asyncio.gather(*tasks)
+
+    async def watchdog_task(self):
         while self.__running:
+            if self.telemetry:
+                self.telemetry.watchdog(self.WATCHDOG_TIMEOUT - time.ticks_diff(time.ticks_ms(), self.__watchdog_fed))
             self.watchdog.feed()
-            if self.mqtt:
-                self.mqtt.ping()
-                self.mqtt.check_msg()
-            self.check_buttons()
-            time.sleep_ms(50)
+            self.__watchdog_fed = time.ticks_ms()
+            await sleep_ms(self.WATCHDOG_FEED_INTERVAL)
 
-    def check_buttons(self):
-        for status, button in self.buttons.items():
-            if button and button.value() == 0:
-                self.set_room_status(status, publish=True)
+    def idle_time(self):
+        """Number of ms until the earliest deadline of any task, 0 if one of them is busy."""
+        due = self.WATCHDOG_FEED_INTERVAL - time.ticks_diff(time.ticks_ms(), self.__watchdog_fed)
+        if self.mqtt:
+            due = min(due, self.mqtt.tick_due())
+        if self.matrix:
+            if self.matrix_started:
+                outbox_due = self.outbox.due_in()
+                if outbox_due is not None:
+                    due = min(due, outbox_due)
+            elif self.__matrix_login_at is not None:
+                # logging in, or waiting to try that again
+                due = min(due, time.ticks_diff(self.__matrix_login_at, time.ticks_ms()))
+        if self.telemetry:
+            due = min(due, self.telemetry.due_in(), time.ticks_diff(self.__telemetry_at, time.ticks_ms()))
+        for other_due in (self.wifi.due_in(), self.buttons.due_in(), self.journal.due_in(), self.resolver.due_in()):
+            if other_due is not None:
+                due = min(due, other_due)
+        return max(due, 0)
+
+    async def idle_task(self):
+        # Runs after all other ready tasks. If none of them has work before the next deadline,
+        # the board sleeps until then or until a button or the MQTT socket wakes it up.
+        while self.__running:
+            await sleep_ms(0)
+            streams = [self.buttons.flag]
+            if self.mqtt and self.mqtt.isconnected():
+                streams.append(self.mqtt.sock)
+            if not self.power.sleep(self.idle_time(), streams):
+                await sleep_ms(self.power.min_sleep_ms)
+
+    async def stale_task(self):
+        # Blink the LED of the status restored at boot until the broker confirmed or corrected it. If the
+        # broker has no retained status at all, ours is published once the timeout has passed.
+        blink = False
+        waited = 0
+        while self.__stale:
+            blink = not blink
+            led = self.leds.get(self.__room_status)
+            if led:
+                led.value(blink)
+            await sleep_ms(self.STALE_BLINK_INTERVAL)
+            if self.mqtt.isconnected():
+                waited += self.STALE_BLINK_INTERVAL
+            if waited > self.STALE_TIMEOUT and self.__stale:
+                print("broker has no status, publishing the restored one")
+                self.__stale = False
+                self.publish_status_to_mqtt(self.__room_status)
+        self.update_leds()
+
+    async def telemetry_task(self):
+        # a period in which the broker was not reachable is reported with the next one
+        while self.__running:
+            self.__telemetry_at = time.ticks_add(time.ticks_ms(), self.telemetry_interval)
+            await sleep_ms(self.telemetry_interval)
+            if self.mqtt.isconnected():
+                self.mqtt.publish(self.telemetry_topic, self.telemetry.report())
+
+    async def wifi_task(self):
+        while self.__running:
+            await sleep_ms(self.wifi.poll())
+
+    async def button_task(self):
+        while self.__running:
+            status, event = await self.buttons.get()
+            self.handle_button(status, event)
+
+    async def mqtt_task(self):
+        config = self.config['mqtt']
+        await self.wifi.wait_connected()
+        # this sleep is needed to fix some init race condition
+        await sleep_ms(300)
+        print("connecting to mqtt server at", config['broker'], config['brokerport'])
+        self.mqtt.start()
+        await self.mqtt.run()
+
+    async def matrix_task(self):
+        delay = self.MATRIX_RETRY_DELAY
+        while True:
+            try:
+                await self.start_matrix()
+                break
+            except Exception as e:
+                # messages are queued meanwhile, the homeserver being down or busy is no reason to reset
+                delay = getattr(e, 'retry_after_ms', None) or delay
+                print("matrix login failed, retrying in", delay, "ms:", e)
+                self.__matrix_login_at = time.ticks_add(time.ticks_ms(), delay)
+                await sleep_ms(delay)
+                delay = min(delay * 2, self.MATRIX_RETRY_MAX_DELAY)
+        self.matrix_started = True
+        # a room that cannot be joined must not hold up messages to the others
+        asyncio.create_task(self.update_matrix_profile())
+        await self.outbox.run()
+
+    def handle_button(self, status, event):
+        from buttons import ButtonEvent
+
+        if event == ButtonEvent.PRESS:
+            # pressing the button of a stale status restored at boot confirms it
+            self.set_room_status(status, publish=True, force_update=self.__stale)
+        elif event == ButtonEvent.LONG_PRESS:
+            # holding a button sets and announces its status again, even if it is already set
+            self.set_room_status(status, publish=True, force_update=True)
 
     def update_leds(self):
         for status, led in self.leds.items():
@@ -164,12 +662,24 @@ class Application():
                 led.value(self.__room_status == status)
 
     def publish_to_matrix(self, status_config, status_to_send):
-        if not (status_config or status_config.get('matrix_rooms') or self.matrix):
+        if not (status_config and status_config.matrix_rooms and self.matrix):
             return
-        message = "Room Status is now " + self.translate_status_to_human(status_to_send)
-        for room in status_config['matrix_rooms']:
-            print("writing status to matrix:", room)
-            self.matrix.send_room_message(room, message)
+        status_to_send_config = self.config_for_status(status_to_send)
+        if status_to_send_config:
+            message = status_to_send_config.announcement
+        else:
+            message = self.status_table.unknown_announcement
+        for room in status_config.matrix_rooms:
+            print("queueing status for matrix:", room)
+            self.outbox.put(room, message)
+
+    def publish_status_to_mqtt(self, status):
+        if not (self.mqtt and self.statustopic):
+            return
+        message = self.translate_status_to_mqtt(status)
+        self.journal.set('mqtt', self.statustopic.decode(), message.decode())
+        print("writing status to mqtt:", self.statustopic)
+        self.__status_pid = self.mqtt.publish(self.statustopic, message, retain=True, qos=1)
 
     def set_room_status(self, new_status, publish=True, force_update=False):
         old_status = self.__room_status
@@ -183,15 +693,14 @@ class Application():
         self.__room_status = new_status
         self.__room_status_updated = time.ticks_ms()
         self.update_leds()
+        self.save_snapshot(new_status)
 
         if not publish:
             return
+        # the status was set here, so it no longer waits for the broker
+        self.__stale = False
 
-        if self.mqtt:
-            statustopic = self.config.get('mqtt', {}).get('statustopic')
-            if statustopic:
-                print("writing status to mqtt:", statustopic)
-                self.mqtt.publish(statustopic, self.translate_status_to_mqtt(new_status), retain=True)
+        self.publish_status_to_mqtt(new_status)
 
         if new_status == RoomStatus.CLOSED:
             # The closed status is a special case since we want to announce it to different rooms depending if we were public or private open.
@@ -199,7 +708,6 @@ class Application():
             status_config = self.config_for_status(old_status)
             self.publish_to_matrix(status_config, new_status)
         else:
-            status_config = self.config_for_status(new_status)
             self.publish_to_matrix(self.config_for_status(new_status), new_status)
 
         if new_status == RoomStatus.INTERNAL_OPEN and old_status == RoomStatus.PUBLIC_OPEN:
@@ -207,11 +715,15 @@ class Application():
             # send a closed message to the public channel
             self.publish_to_matrix(self.config_for_status(RoomStatus.PUBLIC_OPEN), RoomStatus.CLOSED)
 
+app = None
 try:
     app = Application()
-    app.loop()
-    print('app.loop() should never return. resetting...')
+    asyncio.run(app.run())
+    print('app.run() should never return. resetting...')
     machine.reset()
 except Exception as e:
     sys.print_exception(e)
+    if app:
+        # keep undelivered status messages for after the reset
+        app.journal.flush()
     machine.reset()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# End-to-end bench for the status display, running the unmodified src/main.py on a Linux host.
+#
+# Every scenario runs in its own CPython process with the fake board modules from fakes/, a local
+# MQTT broker (broker.py) and a stub Matrix homeserver (homeserver.py) that can inject delay, lost
+# requests and rate limiting. A driver thread presses the status buttons and measures how long each
+# press takes to reach the LED, the retained MQTT status and every Matrix room. A probe task in the
+# event loop measures how late its sleeps wake up, which is the jitter every other task sees.
+#
+#   python3 tools/bench/bench.py                      all scenarios
+#   python3 tools/bench/bench.py -s rate_limited -v   one scenario, with the output of the application
+#   python3 tools/bench/bench.py --json               results as JSON
+#
+# The broker and homeserver need threads and http.server, so the bench runs under CPython only.
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+SCENARIOS = {
+    "baseline": {},
+    "slow_broker": {"broker": {"delay_ms": 100}},
+    "slow_homeserver": {"homeserver": {"delay_ms": 300}},
+    "lossy_homeserver": {"homeserver": {"loss": 0.2}},
+    "rate_limited": {"homeserver": {"limit_every": 3, "retry_after_ms": 2000}},
+}
+
+STATUS_TOPIC = "/bench/status"
+ROOMS = ["!public:localhost", "!internal:localhost"]
+
+# the statuses the buttons alternate between: (mqtt name, button pin, led pin, human name)
+PRESSES = [
+    ("public_open", 9, 8, "Publicly open"),
+    ("closed", 7, 19, "Closed"),
+]
+
+# a status change within 3 s of the previous one is ignored by the application
+PRESS_INTERVAL = 3.2
+# time given to retries after the last press
+DRAIN_TIME = 10
+LOOP_PROBE_MS = 10
+
+
+def make_config(broker, homeserver):
+    return {
+        "wifi": {"ssid": "bench", "password": "bench", "ifconfig": None},
+        "mqtt": {
+            "broker": "127.0.0.1",
+            "brokerport": broker.port,
+            "statustopic": STATUS_TOPIC,
+            "devicename": "bench",
+        },
+        "matrix": {
+            "homeserver": homeserver.url,
+            "matrix_id": "@bench:localhost",
+            "access_token": "bench",
+            "username": None,
+            "password": None,
+            "displayname": "Bench",
+            "rooms": ROOMS,
+        },
+        "power": None,
+        "roomstatus": {
+            "_default": {"matrix_rooms": [ROOMS[1]], "mqtt_name": None, "human_name": "Unknown"},
+            "public_open": {
+                "mqtt_name": "public_open",
+                "human_name": "Publicly open",
+                "led_pin": 8,
+                "button_pin": 9,
+                "matrix_rooms": ROOMS,
+            },
+            "internal_open": {
+                "mqtt_name": "internal_open",
+                "human_name": "Open for members",
+                "led_pin": 12,
+                "button_pin": 18,
+            },
+            "closed": {"mqtt_name": "closed", "human_name": "Closed", "led_pin": 19, "button_pin": 7},
+        },
+    }
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list, None if it is empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, total):
+    """p50/p99/max in ms of a list of latencies in seconds, out of total samples."""
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "delivered": len(ms),
+        "total": total,
+        "p50_ms": percentile(ms, 50),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms) if ms else None,
+    }
+
+
+def first_after(events, t0, match):
+    for event in events:
+        if event[0] >= t0 and match(event):
+            return event[0] - t0
+    return None
+
+
+def measure(samples, broker, homeserver):
+    # Latency of every press on every channel, matched by content as presses alternate statuses.
+    import machine
+
+    channels = {"led": [], "mqtt": []}
+    for room in ROOMS:
+        channels["matrix " + room] = []
+    for t0, (mqtt_name, button, led, human_name) in samples:
+        latency = first_after(machine.Pin.pins[led].log, t0, lambda event: event[1] == 1)
+        channels["led"].append(latency)
+        latency = first_after(
+            broker.received, t0, lambda event: event[1] == STATUS_TOPIC and event[2] == mqtt_name.encode()
+        )
+        channels["mqtt"].append(latency)
+        body = "Room Status is now " + human_name
+        for room in ROOMS:
+            latency = first_after(
+                homeserver.delivered, t0, lambda event: event[1] == room and event[2].get("body") == body
+            )
+            channels["matrix " + room].append(latency)
+    return {
+        name: summarize([latency for latency in latencies if latency is not None], len(samples))
+        for name, latencies in channels.items()
+    }
+
+
+def drive(broker, homeserver, presses, loop_lateness):
+    import machine
+
+    deadline = time.monotonic() + 15
+    while not broker.connected or len(homeserver.joined) < len(ROOMS):
+        if time.monotonic() > deadline:
+            print("BENCH " + json.dumps({"error": "application did not start"}), flush=True)
+            os._exit(1)
+        time.sleep(0.05)
+    # the retained status just received counts as a change, see PRESS_INTERVAL
+    time.sleep(PRESS_INTERVAL)
+
+    samples = []
+    for i in range(presses):
+        press = PRESSES[i % len(PRESSES)]
+        t0 = time.monotonic()
+        machine.Pin.pins[press[1]].press(50)
+        samples.append((t0, press))
+        time.sleep(PRESS_INTERVAL)
+    time.sleep(DRAIN_TIME)
+
+    result = measure(samples, broker, homeserver)
+    result["loop jitter"] = {
+        "samples": len(loop_lateness),
+        "p50_ms": percentile(loop_lateness, 50),
+        "p99_ms": percentile(loop_lateness, 99),
+        "max_ms": max(loop_lateness) if loop_lateness else None,
+    }
+    result["homeserver"] = {
+        "sends": homeserver.sends,
+        "limited": homeserver.limited,
+        "dropped": homeserver.dropped,
+    }
+    print("BENCH " + json.dumps(result), flush=True)
+    os._exit(0)
+
+
+def install_loop_probe(lateness):
+    # Wrap asyncio.run so a probe task runs next to the application in the same loop.
+    import asyncio
+
+    run = asyncio.run
+
+    async def probe():
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_PROBE_MS / 1000)
+            lateness.append((time.monotonic() - start) * 1000 - LOOP_PROBE_MS)
+
+    async def with_probe(main):
+        task = asyncio.create_task(probe())
+        try:
+            return await main
+        finally:
+            task.cancel()
+
+    asyncio.run = lambda main: run(with_probe(main))
+
+
+def run_scenario(name, presses):
+    # Runs in the scenario process and never returns, the driver thread ends the process.
+    import runpy
+    import traceback
+
+    sys.path[:0] = [os.path.join(BENCH_DIR, "fakes"), os.path.join(ROOT, "src", "lib"), BENCH_DIR]
+    sys.print_exception = traceback.print_exception
+
+    import machine
+    from broker import Broker
+    from homeserver import Homeserver
+
+    scenario = SCENARIOS[name]
+    broker = Broker(**scenario.get("broker", {}))
+    homeserver = Homeserver(**scenario.get("homeserver", {}))
+    broker.retained[STATUS_TOPIC] = b"closed"
+
+    os.chdir(tempfile.mkdtemp(prefix="statusdisplay-bench-"))
+    with open("config_base.json", "w") as f:
+        json.dump(make_config(broker, homeserver), f)
+    with open("config_device.json", "w") as f:
+        json.dump({}, f)
+
+    loop_lateness = []
+    install_loop_probe(loop_lateness)
+    threading.Thread(target=drive, args=(broker, homeserver, presses, loop_lateness), daemon=True).start()
+    try:
+        runpy.run_path(os.path.join(ROOT, "src", "main.py"), run_name="__main__")
+    except machine.Reset:
+        pass
+    print("BENCH " + json.dumps({"error": "application reset the board"}), flush=True)
+    os._exit(1)
+
+
+def spawn(name, presses, verbose):
+    # Run a scenario in a fresh process and return its result.
+    command = [sys.executable, os.path.abspath(__file__), "--run", name, "--presses", str(presses)]
+    proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    result = {"error": "no result, exit status %d" % proc.returncode}
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH "):
+            result = json.loads(line[6:])
+        elif verbose:
+            print("  |", line)
+    return result
+
+
+def format_ms(value):
+    return "-" if value is None else "%.1f" % value
+
+
+def print_table(results):
+    print("%-18s %-28s %9s %9s %9s %9s" % ("scenario", "channel", "n", "p50 ms", "p99 ms", "max ms"))
+    for name, result in results.items():
+        if "error" in result:
+            print("%-18s %s" % (name, result["error"]))
+            continue
+        for channel, stats in result.items():
+            if channel == "homeserver":
+                continue
+            if "samples" in stats:
+                count = str(stats["samples"])
+            else:
+                count = "%d/%d" % (stats["delivered"], stats["total"])
+            print(
+                "%-18s %-28s %9s %9s %9s %9s"
+                % (
+                    name,
+                    channel,
+                    count,
+                    format_ms(stats["p50_ms"]),
+                    format_ms(stats["p99_ms"]),
+                    format_ms(stats["max_ms"]),
+                )
+            )
+            name = ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency bench of the status display.")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="run only these")
+    parser.add_argument("-n", "--presses", type=int, default=8, help="button presses per scenario")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of the application")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_scenario(args.run, args.presses)
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        if not args.json:
+            print("running", name, file=sys.stderr)
+        results[name] = spawn(name, args.presses, args.verbose)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
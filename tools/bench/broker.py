@@ -0,0 +1,153 @@
+# A minimal MQTT 3.1.1 broker running in threads of the bench process.
+#
+# It knows just enough for the status display: CONNECT, SUBSCRIBE with wildcards, PUBLISH with QoS 0
+# and 1, retained messages and PINGREQ. Every PUBLISH it receives is recorded with its arrival time.
+
+import socket
+import struct
+import threading
+import time
+
+
+def _encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def matches(topic_filter, topic):
+    """Whether a topic matches a subscription filter with + and # wildcards."""
+    levels = topic.split("/")
+    for i, part in enumerate(topic_filter.split("/")):
+        if part == "#":
+            return True
+        if i >= len(levels) or part not in ("+", levels[i]):
+            return False
+    return len(topic_filter.split("/")) == len(levels)
+
+
+class Broker:
+    """Listens on a free port of 127.0.0.1, see port.
+
+    Messages are forwarded delay_ms after they arrived.
+    """
+
+    def __init__(self, delay_ms=0):
+        self.delay_ms = delay_ms
+        self.retained = {}
+        # (time.monotonic(), topic, message, retain) of every PUBLISH received from a client
+        self.received = []
+        self._clients = []
+        self._lock = threading.Lock()
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(8)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def connected(self):
+        """Number of clients with at least one subscription."""
+        with self._lock:
+            return len([subscriptions for conn, subscriptions in self._clients if subscriptions])
+
+    def _accept(self):
+        while True:
+            conn, _ = self._server.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _read(self, conn, n):
+        data = b""
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _serve(self, conn):
+        subscriptions = []
+        client = (conn, subscriptions)
+        try:
+            while True:
+                header = self._read(conn, 1)[0]
+                length = 0
+                shift = 0
+                while True:
+                    byte = self._read(conn, 1)[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self._read(conn, length)
+                kind = header & 0xF0
+                if kind == 0x10:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                    with self._lock:
+                        self._clients.append(client)
+                elif kind == 0x80:
+                    self._subscribe(conn, subscriptions, body)
+                elif kind == 0x30:
+                    self._publish(conn, header, body)
+                elif kind == 0xC0:
+                    conn.sendall(b"\xd0\x00")
+                elif kind == 0xE0:
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+            conn.close()
+
+    def _subscribe(self, conn, subscriptions, body):
+        pid = body[:2]
+        i = 2
+        new = []
+        while i < len(body):
+            n = struct.unpack("!H", body[i : i + 2])[0]
+            new.append(body[i + 2 : i + 2 + n].decode())
+            i += 3 + n
+        conn.sendall(bytes([0x90]) + _encode_length(2 + len(new)) + pid + b"\x00" * len(new))
+        for topic_filter in new:
+            for topic, message in list(self.retained.items()):
+                if matches(topic_filter, topic):
+                    self._send(conn, topic, message, True)
+        subscriptions.extend(new)
+
+    def _publish(self, conn, header, body):
+        n = struct.unpack("!H", body[:2])[0]
+        topic = body[2 : 2 + n].decode()
+        i = 2 + n
+        if header & 0x06:
+            conn.sendall(b"\x40\x02" + body[i : i + 2])
+            i += 2
+        message = bytes(body[i:])
+        retain = bool(header & 1)
+        self.received.append((time.monotonic(), topic, message, retain))
+        if self.delay_ms:
+            time.sleep(self.delay_ms / 1000)
+        self.publish(topic, message, retain, exclude=conn)
+
+    def _send(self, conn, topic, message, retain=False):
+        topic = topic.encode()
+        body = struct.pack("!H", len(topic)) + topic + message
+        conn.sendall(bytes([0x30 | retain]) + _encode_length(len(body)) + body)
+
+    def publish(self, topic, message, retain=False, exclude=None):
+        """Send a message to all subscribers of the topic, as if a client published it."""
+        if retain:
+            self.retained[topic] = message
+        with self._lock:
+            for conn, subscriptions in self._clients:
+                if conn is not exclude and any(matches(f, topic) for f in subscriptions):
+                    try:
+                        self._send(conn, topic, message)
+                    except OSError:
+                        pass
@@ -0,0 +1,88 @@
+# Pins, watchdog and RTC of the board, recording what the application does with them.
+#
+# Every pin keeps a log of (time.monotonic(), value) for each change of its output value, and
+# press() drives an input pin low and high again the way a button does, calling its irq handler.
+
+import time as _time
+
+SLEEP = 2
+DEEPSLEEP = 4
+
+
+class Reset(BaseException):
+    """Raised by reset(), so the bench notices when the application gives up."""
+
+
+def reset():
+    raise Reset()
+
+
+def freq(hz=None):
+    return 160000000
+
+
+def lightsleep(ms=None):
+    _time.sleep((ms or 0) / 1000)
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    # number -> Pin, the last one created for it
+    pins = {}
+
+    def __init__(self, number, mode=IN, pull=None):
+        self.number = number
+        self._value = 1 if pull == self.PULL_UP else 0
+        self.handler = None
+        self.log = []
+        Pin.pins[number] = self
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        value = int(bool(value))
+        if value != self._value:
+            self._value = value
+            self.log.append((_time.monotonic(), value))
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=None, wake=None):
+        self.handler = handler
+
+    def press(self, ms=100):
+        """Hold the button down for ms, from the calling thread."""
+        for level in (0, 1):
+            self._value = level
+            if self.handler:
+                self.handler(self)
+            if not level:
+                _time.sleep(ms / 1000)
+
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        pass
+
+    def feed(self):
+        pass
+
+
+_rtc_memory = b""
+
+
+class RTC:
+    def memory(self, data=None):
+        global _rtc_memory
+        if data is None:
+            return _rtc_memory
+        _rtc_memory = data.encode() if isinstance(data, str) else bytes(data)
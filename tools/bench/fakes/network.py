@@ -0,0 +1,44 @@
+# A station interface that is associated as soon as it is asked to connect.
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+STAT_NO_AP_FOUND = 201
+STAT_WRONG_PASSWORD = 202
+STAT_CONNECT_FAIL = 203
+
+# what scan() returns: (ssid, bssid, channel, rssi, authmode, hidden)
+access_points = [(b"bench", b"\x02\x00\x00\x00\x00\x01", 6, -50, 3, 0)]
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._connected = False
+
+    def active(self, active=None):
+        return True
+
+    def ifconfig(self, config=None):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+    def isconnected(self):
+        return self._connected
+
+    def status(self, param=None):
+        return STAT_GOT_IP if self._connected else STAT_IDLE
+
+    def connect(self, ssid=None, password=None, bssid=None):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def scan(self):
+        return list(access_points)
+
+    def config(self, *args, **kwargs):
+        if args:
+            return b"\x02\x00\x00\x00\x00\x02"
@@ -0,0 +1,2 @@
+# uarray on the host is the CPython array module
+from array import *
@@ -0,0 +1,2 @@
+# ubinascii on the host is the CPython binascii module
+from binascii import *
@@ -0,0 +1,2 @@
+# uerrno on the host is the CPython errno module
+from errno import *
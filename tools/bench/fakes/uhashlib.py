@@ -0,0 +1,2 @@
+# uhashlib on the host is the CPython hashlib module
+from hashlib import *
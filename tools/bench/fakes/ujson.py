@@ -0,0 +1,2 @@
+# ujson on the host is the CPython json module
+from json import *
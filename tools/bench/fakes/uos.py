@@ -0,0 +1,2 @@
+# uos on the host is the CPython os module
+from os import *
@@ -0,0 +1,2 @@
+# urandom on the host is the CPython random module
+from random import *
@@ -0,0 +1,2 @@
+# uselect on the host is the CPython select module
+from select import *
@@ -0,0 +1,88 @@
+# MicroPython style stream sockets on top of CPython sockets.
+#
+# MicroPython sockets have read(), readinto() and write() that return None instead of raising when a
+# non-blocking socket has no data or no buffer space, and raise OSError(ETIMEDOUT) when a timeout set
+# with settimeout() has passed.
+
+import errno as _errno
+import socket as _socket
+from socket import getaddrinfo, AF_INET, SOCK_STREAM, SOCK_DGRAM, IPPROTO_TCP, SOL_SOCKET, SO_REUSEADDR
+
+
+class socket:
+    def __init__(self, af=AF_INET, type=SOCK_STREAM, proto=0):
+        self._sock = _socket.socket(af, type, proto)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def setsockopt(self, level, option, value):
+        self._sock.setsockopt(level, option, value)
+
+    def connect(self, address):
+        try:
+            self._sock.connect(address)
+        except _socket.timeout:
+            raise OSError(_errno.ETIMEDOUT)
+
+    def close(self):
+        self._sock.close()
+
+    def _blocking(self):
+        # with a timeout, calls block too and raise once it has passed
+        return self._sock.gettimeout() != 0
+
+    def read(self, n=4096):
+        if self._blocking():
+            data = b""
+            while len(data) < n:
+                try:
+                    chunk = self._sock.recv(n - len(data))
+                except _socket.timeout:
+                    raise OSError(_errno.ETIMEDOUT)
+                if not chunk:
+                    break
+                data += chunk
+            return data
+        try:
+            return self._sock.recv(n)
+        except BlockingIOError:
+            return None
+
+    def readinto(self, buf, n=None):
+        try:
+            return self._sock.recv_into(buf, n or 0)
+        except _socket.timeout:
+            raise OSError(_errno.ETIMEDOUT)
+        except BlockingIOError:
+            return None
+
+    def write(self, data, n=None):
+        if isinstance(data, str):
+            data = data.encode()
+        if n is not None:
+            data = memoryview(data)[:n]
+        if self._blocking():
+            try:
+                self._sock.sendall(data)
+            except _socket.timeout:
+                raise OSError(_errno.ETIMEDOUT)
+            return len(data)
+        try:
+            return self._sock.send(data)
+        except BlockingIOError:
+            return None
+
+    send = write
+
+    def sendto(self, data, address):
+        return self._sock.sendto(data, address)
+
+    def recv(self, n):
+        return self._sock.recv(n)
@@ -0,0 +1,2 @@
+# ustruct on the host is the CPython struct module
+from struct import *
@@ -0,0 +1,38 @@
+# The MicroPython time functions on top of the CPython time module.
+#
+# Ticks are milliseconds since the bench started and never wrap, so ticks_diff and ticks_add are
+# plain arithmetic. The functions are also added to the CPython time module, as main.py and wifi.py
+# use them from there like MicroPython allows.
+
+import time as _time
+from time import sleep, time, localtime, gmtime, mktime
+
+_start = _time.monotonic()
+
+
+def ticks_ms():
+    return int((_time.monotonic() - _start) * 1000)
+
+
+def ticks_us():
+    return int((_time.monotonic() - _start) * 1000000)
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def ticks_add(a, b):
+    return a + b
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+
+for _name in ("ticks_ms", "ticks_us", "ticks_diff", "ticks_add", "sleep_ms", "sleep_us"):
+    setattr(_time, _name, globals()[_name])
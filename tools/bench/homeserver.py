@@ -0,0 +1,92 @@
+# A stub Matrix homeserver answering the few client API requests of the status display.
+#
+# Faults can be injected into room message sends: every response is delayed by delay_ms, a request
+# is answered by closing the connection with probability loss, and every limit_every-th send is
+# answered with 429 M_LIMIT_EXCEEDED asking to retry after retry_after_ms.
+
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class Homeserver:
+    """Serves on a free port of 127.0.0.1, see url."""
+
+    def __init__(self, delay_ms=0, loss=0.0, limit_every=0, retry_after_ms=1000, seed=1):
+        self.delay_ms = delay_ms
+        self.loss = loss
+        self.limit_every = limit_every
+        self.retry_after_ms = retry_after_ms
+        # (time.monotonic(), room, body) of every message send answered with 200
+        self.delivered = []
+        self.joined = []
+        self.sends = 0
+        self.limited = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _fault(self):
+        # None, "drop" or "limit" for the next message send
+        with self._lock:
+            self.sends += 1
+            if self.loss and self._random.random() < self.loss:
+                self.dropped += 1
+                return "drop"
+            if self.limit_every and self.sends % self.limit_every == 0:
+                self.limited += 1
+                return "limit"
+        return None
+
+    def _handler(self):
+        homeserver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, data):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if homeserver.delay_ms:
+                    time.sleep(homeserver.delay_ms / 1000)
+                parts = self.path.split("?")[0].split("/")
+                if "login" in parts:
+                    self._reply(200, {"access_token": "bench", "user_id": "@bench:localhost"})
+                elif "join" in parts:
+                    homeserver.joined.append(parts[parts.index("join") - 1])
+                    self._reply(200, {"room_id": parts[parts.index("join") - 1]})
+                elif "send" not in parts:
+                    self._reply(200, {})
+                else:
+                    fault = homeserver._fault()
+                    if fault == "drop":
+                        self.close_connection = True
+                        return
+                    if fault == "limit":
+                        data = {"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": homeserver.retry_after_ms}
+                        self._reply(429, data)
+                        return
+                    room = parts[parts.index("rooms") + 1]
+                    homeserver.delivered.append((time.monotonic(), room, json.loads(body)))
+                    self._reply(200, {"event_id": "$%d" % homeserver.sends})
+
+            do_GET = do_POST = do_PUT = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
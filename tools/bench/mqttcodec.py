@@ -0,0 +1,346 @@
+# Micro-benchmark of the MQTT packet encoding and decoding in src/lib/mqtt.py.
+#
+# MQTTClientSimple is connected to an in-memory stream instead of a socket, with the broker side
+# written into the stream by the bench. Every case reports packets per second, socket calls per
+# packet (each is a syscall on a real socket) and bytes allocated per packet:
+#
+#   connect     CONNECT and CONNACK
+#   subscribe   SUBSCRIBE and SUBACK
+#   publish     PUBLISH, with QoS 1 also the PUBACK
+#   wait_msg    an incoming PUBLISH, with QoS 1 also the PUBACK sent back
+#   check_msg   the same, reading whatever arrived
+#
+# The broker side sends incoming PUBLISH packets in bursts of 8.
+#
+# Allocations are counted exactly with gc.mem_alloc() on MicroPython. CPython has no such counter,
+# there the peak of tracemalloc during a packet is reported instead.
+#
+#   python3 tools/bench/mqttcodec.py [--count N] [--compare old.json] > new.json
+#   micropython tools/bench/mqttcodec.py
+#
+# The results are JSON on stdout. With --compare, the change of packets per second against an
+# earlier run is printed to stderr.
+
+import gc
+import json
+import sys
+
+if sys.implementation.name != "micropython":
+    _dir = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+    sys.path[:0] = [_dir + "/fakes", _dir + "/../../src/lib"]
+
+import utime
+import mqtt
+
+TOPIC_SIZES = (8, 64)
+PAYLOAD_SIZES = (16, 256, 2048)
+CHECK_MSG_BATCH = 8
+ALLOC_SAMPLES = 20
+
+
+class MemoryStream:
+    """A non-blocking socket whose peer is the bench. Counts the calls that would be syscalls.
+
+    The data the broker sends is fed as a repeated pattern, so preparing many packets allocates
+    nothing per packet. A read returns at most up to the end of the pattern, like
+    a socket returns what arrived in one segment.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.written = 0
+        self._view = memoryview(b"")
+        self._pos = 0
+        self._left = 0
+
+    def feed(self, data, size=None):
+        """Make size bytes readable, data repeated as often as needed (once by default).
+
+        Data not read yet is replaced, so feed only once the client has read everything up to a packet
+        boundary.
+        """
+        self._view = memoryview(data)
+        self._pos = 0
+        self._left = len(data) if size is None else size
+
+    def pending(self):
+        """Number of bytes not read yet."""
+        return self._left
+
+    def _take(self, n):
+        n = min(n, self._left, len(self._view) - self._pos)
+        view = self._view[self._pos : self._pos + n]
+        self._pos = (self._pos + n) % len(self._view)
+        self._left -= n
+        return view
+
+    def readinto(self, buf, n=None):
+        self.calls += 1
+        if not self._left:
+            return None
+        view = self._take(min(n or len(buf), len(buf)))
+        buf[: len(view)] = view
+        return len(view)
+
+    def read(self, n):
+        self.calls += 1
+        return bytes(self._take(n))
+
+    def write(self, buf, n=None):
+        self.calls += 1
+        n = len(buf) if n is None else n
+        self.written += n
+        return n
+
+    def connect(self, address):
+        self.calls += 1
+
+    def setblocking(self, flag):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class SocketModule:
+    """Stands in for usocket in the mqtt module, handing out the bench stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def socket(self, *args):
+        return self.stream
+
+
+def packet(op, body):
+    n = len(body)
+    header = bytearray([op])
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        header.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(header) + body
+
+
+def pid_bytes(pid):
+    return bytes([pid >> 8, pid & 0xFF])
+
+
+def incoming_publish(topic, payload, qos, pid=1):
+    body = pid_bytes(len(topic)) + topic + (pid_bytes(pid) if qos else b"") + payload
+    return packet(0x30 | qos << 1, body)
+
+
+CONNACK = packet(0x20, b"\x00\x00")
+
+
+class Receiver:
+    """Callback counting the PUBLISH packets delivered by the client."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, topic, msg):
+        self.count += 1
+
+
+def connected_client():
+    stream = MemoryStream()
+    mqtt.socket = SocketModule(stream)
+    client = mqtt.MQTTClientSimple("bench", "127.0.0.1", keepalive=0)
+    client.set_callback(Receiver())
+    stream.feed(CONNACK)
+    client.connect()
+    return client, stream
+
+
+def now_us():
+    return utime.ticks_us()
+
+
+def allocated(op, ops):
+    # bytes allocated by ops calls of op
+    total = 0
+    if sys.implementation.name == "micropython":
+        for _ in range(ops):
+            gc.collect()
+            gc.disable()
+            before = gc.mem_alloc()
+            op()
+            total += gc.mem_alloc() - before
+            gc.enable()
+    else:
+        import tracemalloc
+
+        tracemalloc.start()
+        for _ in range(ops):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            op()
+            total += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+    return total
+
+
+def measure(case, client, stream, prepare, op, count, **params):
+    # prepare(n) feeds the stream with what n calls of op read. Incoming PUBLISH packets are counted
+    # by the callback, other cases handle one packet per call.
+    receiver = client.cb
+
+    def packets(ops, received):
+        return receiver.count - received if receiver.count > received else ops
+
+    prepare(10)
+    for _ in range(10):
+        op()
+
+    prepare(count)
+    calls = stream.calls
+    received = receiver.count
+    start = now_us()
+    for _ in range(count):
+        op()
+    elapsed = utime.ticks_diff(now_us(), start)
+    calls = stream.calls - calls
+    timed = packets(count, received)
+
+    prepare(ALLOC_SAMPLES)
+    received = receiver.count
+    alloc = allocated(op, ALLOC_SAMPLES)
+
+    result = {"case": case}
+    result.update(params)
+    result["packets"] = timed
+    result["packets_per_s"] = round(timed * 1000000 / max(elapsed, 1))
+    result["calls_per_packet"] = round(calls / timed, 3)
+    result["alloc_bytes_per_packet"] = round(alloc / packets(ALLOC_SAMPLES, received), 1)
+    return result
+
+
+def bench_connect(count):
+    client, stream = connected_client()
+
+    def prepare(n):
+        stream.feed(CONNACK, n * len(CONNACK))
+
+    return [measure("connect", client, stream, prepare, client.connect, count)]
+
+
+def bench_subscribe(count):
+    results = []
+    for topic_size in TOPIC_SIZES:
+        client, stream = connected_client()
+        topic = b"t" * topic_size
+
+        def prepare(n):
+            # the SUBACKs of the next n packet ids
+            pids = [(client.pid + i) % 65535 + 1 for i in range(n)]
+            stream.feed(b"".join([packet(0x90, pid_bytes(pid) + b"\x00") for pid in pids]))
+
+        def op():
+            client.subscribe(topic)
+
+        results.append(measure("subscribe", client, stream, prepare, op, count, topic_size=topic_size))
+    return results
+
+
+def bench_publish(count):
+    results = []
+    for qos in (0, 1):
+        for topic_size in TOPIC_SIZES:
+            for payload_size in PAYLOAD_SIZES:
+                client, stream = connected_client()
+                topic = b"t" * topic_size
+                payload = b"p" * payload_size
+
+                def prepare(n):
+                    # the PUBACKs of the next n packet ids
+                    if qos:
+                        pids = [(client.pid + i) % 65535 + 1 for i in range(n)]
+                        stream.feed(b"".join([packet(0x40, pid_bytes(pid)) for pid in pids]))
+
+                def op():
+                    client.publish(topic, payload, qos=qos)
+                    if qos:
+                        client.wait_msg()
+
+                params = {"qos": qos, "topic_size": topic_size, "payload_size": payload_size}
+                results.append(measure("publish", client, stream, prepare, op, count, **params))
+    return results
+
+
+def bench_receive(count):
+    # The broker sends CHECK_MSG_BATCH packets at a time.
+    results = []
+    for qos in (0, 1):
+        for topic_size in TOPIC_SIZES:
+            for payload_size in PAYLOAD_SIZES:
+                params = {"qos": qos, "topic_size": topic_size, "payload_size": payload_size}
+                batch = incoming_publish(b"t" * topic_size, b"p" * payload_size, qos) * CHECK_MSG_BATCH
+
+                packet_size = len(batch) // CHECK_MSG_BATCH
+
+                client, stream = connected_client()
+
+                def prepare(n):
+                    stream.feed(batch, n * packet_size)
+
+                results.append(measure("wait_msg", client, stream, prepare, client.wait_msg, count, **params))
+
+                client, stream = connected_client()
+
+                def prepare(n):
+                    # check_msg reads what is there, so the previous data may not be used up
+                    while stream.pending():
+                        client.check_msg()
+                    stream.feed(batch, n * len(batch))
+
+                results.append(measure("check_msg", client, stream, prepare, client.check_msg, count, **params))
+    return results
+
+
+def key(result):
+    return tuple(
+        (name, result[name]) for name in sorted(result) if name in ("case", "qos", "topic_size", "payload_size")
+    )
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = {key(result): result for result in json.load(f)["results"]}
+    for result in results:
+        before = old.get(key(result))
+        if not before:
+            continue
+        change = (result["packets_per_s"] - before["packets_per_s"]) * 100 / before["packets_per_s"]
+        label = " ".join("%s=%s" % item for item in key(result))
+        sys.stderr.write("%-60s %+7.1f%% packets/s\n" % (label, change))
+
+
+def main():
+    args = sys.argv[1:]
+    count = 2000
+    compare_with = None
+    while args:
+        arg = args.pop(0)
+        if arg == "--count":
+            count = int(args.pop(0))
+        elif arg == "--compare":
+            compare_with = args.pop(0)
+        else:
+            sys.stderr.write("usage: mqttcodec.py [--count N] [--compare old.json]\n")
+            sys.exit(2)
+
+    results = []
+    for bench in (bench_connect, bench_subscribe, bench_publish, bench_receive):
+        results.extend(bench(count))
+    print(json.dumps({"implementation": sys.implementation.name, "count": count, "results": results}))
+    if compare_with:
+        compare(results, compare_with)
+
+
+main()